@@ -3,7 +3,10 @@ from analysissupport.anipose_support.path_manager import *
 from analysissupport.anipose_support.project_manager import *
 from analysissupport.anipose_support.plot_manager import *
 from analysissupport.anipose_support.data_manager import *
+from analysissupport.anipose_support.triangulation_utils import *
+from analysissupport.anipose_support.filter_utils import *
 from analysissupport.anipose_support.calibration_manager import *
 from analysissupport.anipose_support.label_manager import *
+from analysissupport.anipose_support.pipeline_manager import *
 from analysissupport.anipose_support.aniposesupport import *
     
\ No newline at end of file
@@ -110,11 +110,17 @@ def cli(ctx, config):
 
 @cli.command()
 @click.option('--repeat', default=1, help='Number of template .')
+@click.option('--executor', default=None, type=click.Choice(['process', 'thread']),
+              help='Run the sessions concurrently using a process or thread pool.')
+@click.option('--max_workers', default=None, type=int,
+              help='Maximum number of workers used by the executor.')
 @pass_config
-def generate_template_folder(config):
-    from analysissupport.anipose_support.config_utils import generate_template
+def generate_template_folder(config, repeat, executor, max_workers):
+    from analysissupport.common import process_all
+    from analysissupport.anipose_support.config_utils import generate_session
     click.echo('Creating template of folders ...')
-    generate_template(config)
+    process_all(config, generate_session,
+                executor=executor, max_workers=max_workers, repeat=repeat)
 
 @cli.command()
 @pass_config
@@ -3,13 +3,20 @@ import numpy as np
 import sys, os
 import csv
 import toml
-import glob
+import time
+import shutil
+import queue
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import cv2
 from cv2 import aruco
 from aniposelib.boards import CharucoBoard, Checkerboard
 from aniposelib.cameras import Camera, CameraGroup
 from aniposelib.utils import load_pose2d_fnames
+from analysissupport.common import EXECUTORS, file_fingerprint, file_changed, file_head_hash, match_cam_name
+from analysissupport.dlc_support.auxfun_videos import VideoReader
 
 ARUCO_DICTS = {
     (4, 50): aruco.DICT_4X4_50,
@@ -36,6 +43,213 @@ params.adaptiveThreshWinSizeMin = 100
 params.adaptiveThreshWinSizeMax = 700
 params.adaptiveThreshWinSizeStep = 50
 params.adaptiveThreshConstant = 0
+
+# Calibration settings a cached board detection depends on
+BOARD_KEYS = ['board_type', 'board_size', 'board_marker_bits', 'board_marker_dict_number',
+              'board_marker_length', 'board_square_side_length']
+
+
+def get_calibration_board(config):
+    calib = config['calibration']
+
+    board_size = calib['board_size']
+    board_type = calib['board_type'].lower()
+
+    if board_type == 'aruco':
+        raise NotImplementedError("aruco board is not implemented with the current pipeline")
+    elif board_type == 'charuco':
+        board = CharucoBoard(
+            board_size[0], board_size[1],
+            calib['board_square_side_length'],
+            calib['board_marker_length'],
+            calib['board_marker_bits'],
+            calib['board_marker_dict_number'])
+
+    elif board_type == 'checkerboard':
+        board = Checkerboard(board_size[0], board_size[1],
+                             calib['board_square_side_length'])
+    else:
+        raise ValueError("board_type should be one of "
+                         "'aruco', 'charuco', or 'checkerboard' not '{}'".format(
+            board_type))
+
+    return board
+
+
+def draw_axis(frame, camera_matrix, dist_coeff, boardObj, verbose=True, detection=None):
+    # detection: cached (corners, ids, charuco corners, charuco ids) of this frame, see detect_charuco.
+    # When given the marker detection is skipped and only the pose is estimated and drawn
+    try:
+        if detection is None:
+            corners, ids, rejected_points = cv2.aruco.detectMarkers(frame, boardObj.dictionary, parameters=params)
+
+            if corners is None or ids is None:
+                print('No corner detected')
+                return None
+            if len(corners) != len(ids) or len(corners) == 0:
+                print('Incorrect corner or no corner detected!')
+                return None
+
+            corners, ids, rejectedCorners, recoveredIdxs = cv2.aruco.refineDetectedMarkers(frame, boardObj.board, corners, ids,
+                                                                                           rejected_points,
+                                                                                           camera_matrix,
+                                                                                           dist_coeff,
+                                                                                           parameters=params)
+
+            if len(corners) == 0:
+                return None
+
+            ret, c_corners, c_ids = cv2.aruco.interpolateCornersCharuco(corners, ids,
+                                                                        frame, boardObj.board,
+                                                                        cameraMatrix=camera_matrix,
+                                                                        distCoeffs=dist_coeff)
+        else:
+            corners, ids, c_corners, c_ids = detection
+
+        if c_corners is None or c_ids is None or len(c_corners) < 5:
+            print('No corner detected after interpolation!')
+            return None
+
+        n_corners = c_corners.size // 2
+        reshape_corners = np.reshape(c_corners, (n_corners, 1, 2))
+
+        ret, p_rvec, p_tvec = cv2.aruco.estimatePoseCharucoBoard(reshape_corners,
+                                                                 c_ids,
+                                                                 boardObj.board,
+                                                                 camera_matrix,
+                                                                 dist_coeff)
+
+        if p_rvec is None or p_tvec is None:
+            print('Cant detect rotation!')
+            return None
+        if np.isnan(p_rvec).any() or np.isnan(p_tvec).any():
+            print('Rotation is not usable')
+            return None
+
+        cv2.aruco.drawAxis(image=frame, cameraMatrix=camera_matrix, distCoeffs=dist_coeff,
+                           rvec=p_rvec, tvec=p_tvec, length=20)
+
+        cv2.aruco.drawDetectedCornersCharuco(frame, reshape_corners, c_ids)
+        cv2.aruco.drawDetectedMarkers(frame, corners, ids)
+        # cv2.aruco.drawDetectedMarkers(frame, rejected_points, borderColor=(100, 0, 240))
+
+    except cv2.error as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        print(exc_type, fname, exc_tb.tb_lineno, e)
+        return None
+
+    if verbose:
+        print('Translation : {0}'.format(p_tvec))
+        print('Rotation    : {0}'.format(p_rvec))
+        print('Distance from camera: {0} m'.format(np.linalg.norm(p_tvec)))
+
+    return frame
+
+
+def detect_charuco(frame, boardObj):
+    # Same detection as aniposelib uses for calibration (no intrinsics needed), so the
+    # result can be cached and shared by calibration and the overlay videos
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if len(frame.shape) == 3 else frame
+    corners, ids = boardObj.detect_markers(gray, refine=True)
+    if len(corners) == 0:
+        return None
+
+    ret, c_corners, c_ids = cv2.aruco.interpolateCornersCharuco(corners, ids, gray, boardObj.board)
+    if c_corners is None or c_ids is None or len(c_corners) == 0:
+        return None
+
+    return corners, ids, c_corners, c_ids
+
+
+def scale_detection(detection, scale):
+    if detection is None or scale == 1:
+        return detection
+    corners, ids, c_corners, c_ids = detection
+    return [np.asarray(c) * scale for c in corners], ids, c_corners * scale, c_ids
+
+
+def scale_camera_matrix(camera_matrix, scale):
+    # Intrinsics of the same camera after resizing its frames by scale
+    if scale == 1:
+        return camera_matrix
+    scaled = np.array(camera_matrix, dtype='float64')
+    scaled[:2] *= scale
+    return scaled
+
+
+def board_frame_features(c_corners, c_ids, object_points, size):
+    # Cheap description of the board in one frame, no intrinsics needed: its position and
+    # apparent size in the image, and the affine map from the board plane to the image
+    # (in-plane rotation and foreshortening, i.e. a rough pose)
+    img = np.reshape(c_corners, (-1, 2)) / np.array(size, dtype='float64')
+    obj = object_points[np.ravel(c_ids), :2]
+    A = np.hstack([obj, np.ones((len(obj), 1))])
+    affine, _, rank, _ = np.linalg.lstsq(A, img, rcond=None)
+
+    linear = affine[:2]
+    scale = np.sqrt(abs(np.linalg.det(linear)))
+    if rank < 3 or scale == 0:
+        # Corners on one line, the pose is undefined
+        linear, scale = np.zeros((2, 2)), np.linalg.norm(img.max(axis=0) - img.min(axis=0))
+
+    center = img.mean(axis=0)
+    return np.concatenate([center, [np.log(max(scale, 1e-6))], linear.ravel() / max(scale, 1e-6)])
+
+
+def select_diverse_frames(features, scores, n_frames):
+    # Greedy farthest point sampling weighted by the scores: start from the best frame and
+    # keep adding the frame farthest from everything picked so far
+    if len(scores) <= n_frames:
+        return np.arange(len(scores))
+
+    selected = [int(np.argmax(scores))]
+    dist = np.linalg.norm(features - features[selected[0]], axis=1)
+    for _ in range(n_frames - 1):
+        best = int(np.argmax(dist * scores))
+        if dist[best] <= 0:
+            break
+        selected.append(best)
+        dist = np.minimum(dist, np.linalg.norm(features - features[best], axis=1))
+
+    return np.sort(selected)
+
+
+def board_coverage(corners, size, grid=10):
+    # Fraction of a grid x grid division of the image that has at least one board corner
+    if len(corners) == 0:
+        return 0.0
+    corners = np.reshape(np.concatenate([np.reshape(c, (-1, 2)) for c in corners]), (-1, 2))
+    cells = np.floor(corners / np.array(size, dtype='float64') * grid).astype(int)
+    cells = np.clip(cells, 0, grid - 1)
+    return len(set(map(tuple, cells))) / float(grid * grid)
+
+
+# Board used by the labeling worker processes. OpenCV boards cannot be pickled,
+# so each worker builds its own from the config when it starts
+worker_board = None
+
+
+def init_label_worker(config):
+    global worker_board
+    worker_board = get_calibration_board(config)
+
+
+def label_frame_batch(frames, camera_matrix, dist_coeff, detections=None):
+    if detections is None:
+        detections = [None] * len(frames)
+
+    labeled = []
+    for frame, detection in zip(frames, detections):
+        if detection is False:
+            # Cached as having no board, nothing to draw
+            labeled.append(frame)
+            continue
+        axis_frame = draw_axis(frame, camera_matrix, dist_coeff, worker_board, False, detection=detection)
+        labeled.append(axis_frame if axis_frame is not None else frame)
+    return labeled
+
+
 class CalibrationManager:
     def __init__(self, ProjectManager) -> None:
         for key, val in vars(ProjectManager).items():
@@ -46,17 +260,35 @@ class CalibrationManager:
     def check_calibration(self):
         calib_file = os.path.join(self.calib_path, str("calibration.toml"))
 
+        registered = None
+        if not os.path.exists(calib_file):
+            registered = self.find_registered_calibration()
+
         if os.path.exists(calib_file):
             print('\nCalibration file was found. Loading calibrated file ...')
             cgroup = CameraGroup.load(calib_file)
+            self.register_calibration(calib_file)
+            print('Done calibration loaded!')
+        elif registered is not None:
+            print('\nCalibration file was not found. Reusing the registered calibration from:')
+            print(registered['calibration'])
+            print('(rig {rig!r}, cameras {cam_names}, recorded {date})'.format(**registered['key']))
+            shutil.copyfile(registered['calibration'], calib_file)
+            cgroup = CameraGroup.load(calib_file)
             print('Done calibration loaded!')
         else:
             print('\nCalibration file was not found. Calibrating using available videos ...')
             print(self.cam_names)
             cgroup = CameraGroup.from_names(self.cam_names)
             videos_calib = [[i] for i in self.videos_calib]
-            error, all_rows = cgroup.calibrate_videos(videos=videos_calib, board=self.boardObj)
+            if self.use_detection_cache() or self.use_frame_selection():
+                all_rows = self.get_calibration_rows(self.videos_calib)
+                cgroup.set_camera_sizes_videos(videos_calib)
+                error = cgroup.calibrate_rows(all_rows, self.boardObj)
+            else:
+                error, all_rows = cgroup.calibrate_videos(videos=videos_calib, board=self.boardObj)
             cgroup.dump(calib_file)
+            self.register_calibration(calib_file)
             print('Done calibration. File saved!')
 
         print('\n Labeling calibration video ...')
@@ -65,6 +297,258 @@ class CalibrationManager:
 
         return cgroup
 
+    def get_registry_fname(self):
+        # Calibration registry shared by sessions, disabled when calibration.registry is empty
+        fname = self.config['calibration'].get('registry', '')
+        if not fname:
+            return None
+        return os.path.abspath(os.path.expanduser(fname))
+
+    def load_registry(self):
+        fname = self.get_registry_fname()
+        if fname is None or not os.path.exists(fname):
+            return {'calibrations': []}
+        registry = toml.load(fname)
+        registry.setdefault('calibrations', [])
+        return registry
+
+    def dump_registry(self, registry):
+        # Written to a temporary file first so a session reading it never sees half a file
+        fname = self.get_registry_fname()
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+        with open(tmp_fname, 'w') as f:
+            toml.dump(registry, f)
+        os.replace(tmp_fname, fname)
+
+    def get_registry_key(self):
+        # Same rig, same board and same capture day means the same calibration. The capture
+        # day is taken from the oldest calibration video
+        calib = self.config['calibration']
+        mtime = min(os.path.getmtime(video) for video in self.videos_calib)
+        return {'rig': calib.get('rig', ''),
+                'cam_names': list(self.cam_names),
+                'board': {k: calib[k] for k in BOARD_KEYS + ['fisheye']},
+                'date': time.strftime('%Y-%m-%d', time.localtime(mtime))}
+
+    def get_calib_videos_fingerprint(self):
+        return [{'name': os.path.basename(video),
+                 'size': os.path.getsize(video),
+                 'head_sha1': file_head_hash(video)}
+                for video in sorted(self.videos_calib)]
+
+    def find_registered_calibration(self):
+        # Registry entry of a calibration made from the same videos (e.g. copies in a sibling
+        # session, whatever their dates). Only with calibration.rig set, otherwise two rigs
+        # with the same camera names could be mixed up, any calibration of the same rig and
+        # board from the same day is reused too
+        if self.get_registry_fname() is None or len(self.videos_calib) == 0:
+            return None
+
+        key = self.get_registry_key()
+        setup = {k: v for k, v in key.items() if k != 'date'}
+        fingerprint = self.get_calib_videos_fingerprint()
+        same_videos, same_key = None, None
+        for entry in self.load_registry()['calibrations']:
+            if not os.path.exists(entry['calibration']):
+                continue
+            entry_setup = {k: v for k, v in entry['key'].items() if k != 'date'}
+            if same_videos is None and entry_setup == setup and entry['videos'] == fingerprint:
+                same_videos = entry
+            if same_key is None and key['rig'] and entry['key'] == key:
+                same_key = entry
+
+        return same_videos if same_videos is not None else same_key
+
+    def register_calibration(self, calib_file):
+        if self.get_registry_fname() is None or len(self.videos_calib) == 0:
+            return
+
+        calib_file = os.path.abspath(calib_file)
+        registry = self.load_registry()
+        if any(entry['calibration'] == calib_file for entry in registry['calibrations']):
+            return
+
+        registry['calibrations'].append({'calibration': calib_file,
+                                         'key': self.get_registry_key(),
+                                         'videos': self.get_calib_videos_fingerprint()})
+        self.dump_registry(registry)
+
+    def use_detection_cache(self):
+        return self.config['calibration'].get('detection_cache', False) \
+            and isinstance(self.boardObj, CharucoBoard)
+
+    def use_frame_selection(self):
+        return self.config['calibration'].get('max_frames', 0) > 0 \
+            and isinstance(self.boardObj, CharucoBoard)
+
+    def load_detection_cache(self):
+        # detections.pickle holds, per calibration video, the board detection of every frame.
+        # It is only valid for the board it was made with
+        board_key = {k: self.config['calibration'][k] for k in BOARD_KEYS}
+        fname = os.path.join(self.calib_path, 'detections.pickle')
+
+        cache = None
+        if os.path.exists(fname):
+            with open(fname, 'rb') as f:
+                cache = pickle.load(f)
+        if cache is None or cache.get('board') != board_key:
+            cache = {'board': board_key, 'videos': {}}
+
+        self.detection_cache = cache
+        return cache
+
+    def dump_detection_cache(self):
+        fname = os.path.join(self.calib_path, 'detections.pickle')
+        with open(fname, 'wb') as f:
+            pickle.dump(self.detection_cache, f)
+
+    def get_video_detections(self, video):
+        # Frame selection needs the detections too, without detection_cache they only live in memory.
+        # Entries are keyed on the calibration videos, so calibration and labeling share them
+        if video not in self.videos_calib:
+            raise ValueError('Detections are only cached for the calibration videos, not ' + video)
+        if not hasattr(self, 'detection_cache'):
+            if self.use_detection_cache():
+                self.load_detection_cache()
+            else:
+                self.detection_cache = {'board': {k: self.config['calibration'][k] for k in BOARD_KEYS},
+                                        'videos': {}}
+
+        name = os.path.basename(video)
+        stride = max(int(self.config['calibration'].get('detection_stride', 1)), 1)
+        entry = self.detection_cache['videos'].get(name)
+        if entry is None or entry.get('stride', 1) != stride or 'size' not in entry \
+                or file_changed(video, entry['fingerprint']):
+            entry = self.detect_calib_video(video)
+            self.detection_cache['videos'][name] = entry
+            if self.use_detection_cache():
+                self.dump_detection_cache()
+
+        return entry
+
+    def detect_calib_video(self, video):
+        # With detection_stride > 1 only every Nth frame is decoded and searched
+        stride = max(int(self.config['calibration'].get('detection_stride', 1)), 1)
+        print('Detecting the board in ' + os.path.basename(video) + ' ...')
+        # Detection only needs the gray image, converted into one reused buffer
+        cap = VideoReader(video, output='gray', reuse_buffer=True, use_cache=True)
+        size = cap.dimensions
+        frames = dict()
+        frame_num = 0
+        while True:
+            if frame_num % stride != 0:
+                if not cap.video.grab():
+                    break
+                frame_num += 1
+                continue
+            frame = cap.read_frame()
+            if frame is None:
+                break
+            detection = detect_charuco(frame, self.boardObj)
+            if detection is not None:
+                frames[frame_num] = detection
+            frame_num += 1
+        cap.close()
+        print('{} boards detected in {} frames'.format(len(frames), frame_num))
+
+        return {'fingerprint': file_fingerprint(video, content_hash=False),
+                'n_frames': frame_num,
+                'stride': stride,
+                'size': size,
+                'frames': frames}
+
+    def get_candidate_frames(self, entry, skip=20):
+        # Frames picked the same way as aniposelib's board.detect_video: every skip-th frame,
+        # and every frame for skip / 2 frames after a detection. A strided cache is already sparse
+        if entry.get('stride', 1) > 1:
+            return sorted(entry['frames'])
+
+        frame_nums = []
+        go = int(skip / 2)
+        for frame_num in range(entry['n_frames']):
+            if frame_num % skip != 0 and go <= 0:
+                continue
+            if frame_num in entry['frames']:
+                go = int(skip / 2)
+                frame_nums.append(frame_num)
+            go = max(0, go - 1)
+        return frame_nums
+
+    def select_calibration_frames(self, entries, candidates, max_frames):
+        # Frames are picked jointly for all cameras so the ones seen by several cameras stay
+        # matched for the extrinsics. Each frame is scored by the fraction of the board seen,
+        # summed over the cameras, and described by the board position and pose in every camera
+        object_points = self.boardObj.get_object_points()
+        n_corners = float(len(object_points))
+        frame_nums = sorted(set().union(*candidates))
+        index = {frame_num: i for i, frame_num in enumerate(frame_nums)}
+
+        features = np.zeros((len(frame_nums), len(entries), 8))
+        scores = np.zeros(len(frame_nums))
+        for cnum, (entry, cam_frames) in enumerate(zip(entries, candidates)):
+            for frame_num in cam_frames:
+                _, _, c_corners, c_ids = entry['frames'][frame_num]
+                i = index[frame_num]
+                features[i, cnum, :7] = board_frame_features(c_corners, c_ids, object_points, entry['size'])
+                features[i, cnum, 7] = 1
+                scores[i] += len(c_ids) / n_corners
+
+        selected = select_diverse_frames(features.reshape(len(frame_nums), -1), scores, max_frames)
+        return set(frame_nums[i] for i in selected)
+
+    def get_calibration_rows(self, videos, skip=20, max_frames=None):
+        # Rows in the format of CameraGroup.calibrate_videos, built from the cache. With
+        # max_frames only a subset of frames covering the image and board poses is kept
+        if max_frames is None:
+            max_frames = self.config['calibration'].get('max_frames', 0)
+
+        entries = [self.get_video_detections(video) for video in videos]
+        candidates = [self.get_candidate_frames(entry, skip) for entry in entries]
+        selected = candidates
+        if max_frames and len(set().union(*candidates)) > max_frames:
+            frames = self.select_calibration_frames(entries, candidates, max_frames)
+            selected = [[f for f in cam_frames if f in frames] for cam_frames in candidates]
+
+        self.report_coverage(videos, entries, candidates, selected)
+
+        all_rows = []
+        for entry, frame_nums in zip(entries, selected):
+            rows = [{'framenum': (0, frame_num),
+                     'corners': entry['frames'][frame_num][2],
+                     'ids': entry['frames'][frame_num][3]}
+                    for frame_num in frame_nums]
+            all_rows.append(self.boardObj.fill_points_rows(rows))
+
+        return all_rows
+
+    def report_coverage(self, videos, entries, candidates, selected):
+        # Per camera: frames with the board, frames used, mean corners per used frame and the
+        # fraction of the image covered by board corners before and after the selection.
+        # Also saved to coverage.toml in the calibration folder
+        stats = dict()
+        print('\nBoard coverage per camera:')
+        for cam_name, video, entry, cam_candidates, cam_selected in zip(self.cam_names, videos, entries,
+                                                                         candidates, selected):
+            corners = [entry['frames'][f][2] for f in cam_selected]
+            stats[cam_name] = {
+                'video': os.path.basename(video),
+                'frames_detected': len(entry['frames']),
+                'frames_candidate': len(cam_candidates),
+                'frames_selected': len(cam_selected),
+                'mean_corners': float(np.mean([len(c) for c in corners])) if corners else 0.0,
+                'coverage_candidate': board_coverage([entry['frames'][f][2] for f in cam_candidates],
+                                                     entry['size']),
+                'coverage_selected': board_coverage(corners, entry['size'])}
+            print('{}: {frames_selected} of {frames_candidate} frames, {mean_corners:.1f} corners per frame, '
+                  'coverage {coverage_selected:.0%} (all frames {coverage_candidate:.0%})'.format(cam_name,
+                                                                                                 **stats[cam_name]))
+
+        with open(os.path.join(self.calib_path, 'coverage.toml'), 'w') as f:
+            toml.dump(stats, f)
+        self.coverage_stats = stats
+        return stats
+
     def load_calibration(self, fname, cam_num=0):
         master_dict = toml.load(fname)
         keys = sorted(master_dict.keys())
@@ -76,12 +560,57 @@ class CalibrationManager:
                np.array(item['rotation'], dtype='float64'), \
                np.array(item['translation'], dtype='float64')
 
-    def label_calib_videos(self, calib_file):
+    def get_calib_video(self, cam_name):
+        # Calibration video of a camera, from the videos the calibration used. The labeled
+        # outputs are written next to them and must not be picked up as a source
+        videos = [video for video in self.videos_calib
+                  if match_cam_name(os.path.basename(video), self.cam_names) == cam_name]
+        if len(videos) != 1:
+            raise ValueError('Expected one calibration video of {}, found {}'.format(cam_name, videos))
+        return videos[0]
+
+    def label_calib_videos(self, calib_file, parallel=None, max_workers=None, batch_size=None,
+                           stride=None, window=None, scale=None, contact_sheet=None, sheet_scale=None):
+        # stride: label every Nth frame, window: [start, end] in seconds, scale: output size
+        # factor, contact_sheet: number of evenly spaced frames tiled into one image instead of a
+        # video, sheet_scale: size factor of its tiles
+        calib = self.config['calibration']
+        if parallel is None:
+            parallel = calib.get('label_parallel', False)
+        if max_workers is None:
+            max_workers = calib.get('label_workers', 0) or None
+        if batch_size is None:
+            batch_size = calib.get('label_batch_size', 32)
+        if stride is None:
+            stride = calib.get('label_stride', 1)
+        if window is None:
+            window = calib.get('label_window', [])
+        if scale is None:
+            scale = calib.get('label_scale', 1.0)
+        if contact_sheet is None:
+            contact_sheet = calib.get('label_contact_sheet', 0)
+        if sheet_scale is None:
+            sheet_scale = calib.get('label_sheet_scale', 0.25)
+
+        render = dict(stride=max(int(stride), 1), window=window if len(window) == 2 else None, scale=scale)
+        preview = render['stride'] > 1 or render['window'] is not None or scale != 1
+        # The render options are part of the names, so changing them gives a new output
+        # instead of keeping the old one as already done
+        window_suffix = '' if render['window'] is None else '_t{:g}-{:g}'.format(*render['window'])
+        preview_suffix = '_preview_stride{}{}_scale{:g}'.format(render['stride'], window_suffix, scale)
+        sheet_suffix = '_sheet{}{}_scale{:g}'.format(int(contact_sheet), window_suffix, sheet_scale)
+
+        jobs = []
         for cam_name in self.cam_names:
             cam_num = int(cam_name[3:]) - 1
-            calib_vid = glob.glob(os.path.join(self.calib_path, str(cam_name + "*" + self.videos_type)))
-            calib_vid = calib_vid[0]
-            calib_label = os.path.join(self.calib_path, str(cam_name + "_calib_labeled" + self.videos_type))
+            calib_vid = self.get_calib_video(cam_name)
+            if contact_sheet:
+                calib_label = os.path.join(self.calib_path, str(cam_name + "_calib" + sheet_suffix + ".png"))
+            elif preview:
+                calib_label = os.path.join(self.calib_path,
+                                           str(cam_name + "_calib_labeled" + preview_suffix + self.videos_type))
+            else:
+                calib_label = os.path.join(self.calib_path, str(cam_name + "_calib_labeled" + self.videos_type))
 
             if os.path.exists(calib_label):
                 print('Labeled calibration video found! Skipping this step ...')
@@ -89,129 +618,207 @@ class CalibrationManager:
 
             ret, camera_matrix, dist_coeff, rotation_vec, translation_vec = self.load_calibration(calib_file,
                                                                                                   cam_num=cam_num)
+            jobs.append((calib_vid, calib_label, camera_matrix, dist_coeff))
 
-            cap = cv2.VideoCapture(calib_vid)
-
-            frameCount = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            frameWidth = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-            frameHeight = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            frameRate = int(cap.get(cv2.CAP_PROP_FPS))
-
-            size = (frameWidth, frameHeight)
-            fourcc = cv2.VideoWriter_fourcc(*'XVID')
-            result = cv2.VideoWriter(calib_label,
-                                     fourcc, frameRate, size)
-            while True:
-                ret, frame = cap.read()
-                if ret:
-                    axis_frame = self.draw_axis(frame, camera_matrix, dist_coeff, self.boardObj, False)
-
-                    if axis_frame is not None:
-                        result.write(axis_frame)
-                    else:
-                        result.write(frame)
-                else:
+        # A strided cache misses most frames, the overlay then detects the board itself
+        if self.use_detection_cache() and max(int(calib.get('detection_stride', 1)), 1) == 1:
+            jobs = [job + (self.get_video_detections(job[0])['frames'],) for job in jobs]
+        else:
+            jobs = [job + (None,) for job in jobs]
+
+        if contact_sheet:
+            for calib_vid, calib_label, camera_matrix, dist_coeff, detections in jobs:
+                self.label_calib_sheet(calib_vid, calib_label, camera_matrix, dist_coeff,
+                                       n_frames=contact_sheet, window=render['window'], scale=sheet_scale,
+                                       detections=detections)
+            return
+
+        if not parallel:
+            for calib_vid, calib_label, camera_matrix, dist_coeff, detections in jobs:
+                self.label_calib_video(calib_vid, calib_label, camera_matrix, dist_coeff,
+                                       detections=detections, **render)
+            return
+
+        # One process pool shared by all cameras, and one thread per camera feeding it.
+        # Workers are spawned rather than forked since forking next to OpenCV threads can hang
+        max_pending = 2 * (max_workers or os.cpu_count() or 1)
+        with EXECUTORS['spawn'](max_workers=max_workers,
+                                initializer=init_label_worker,
+                                initargs=(self.config,)) as pool:
+            with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as cam_pool:
+                futures = [cam_pool.submit(self.label_calib_video_parallel, calib_vid, calib_label,
+                                           camera_matrix, dist_coeff, pool, batch_size, max_pending,
+                                           detections=detections, **render)
+                           for calib_vid, calib_label, camera_matrix, dist_coeff, detections in jobs]
+                for future in futures:
+                    future.result()
+
+    def open_calib_video(self, calib_vid, calib_label, stride=1, scale=1.0):
+        cap = cv2.VideoCapture(calib_vid)
+
+        frameWidth = int(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) * scale)
+        frameHeight = int(int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) * scale)
+        frameRate = max(int(cap.get(cv2.CAP_PROP_FPS)) // stride, 1)
+
+        size = (frameWidth, frameHeight)
+        fourcc = cv2.VideoWriter_fourcc(*'XVID')
+        result = cv2.VideoWriter(calib_label,
+                                 fourcc, frameRate, size)
+        return cap, result
+
+    def iter_calib_frames(self, cap, stride=1, window=None, scale=1.0):
+        # Skipped frames are only grabbed, not retrieved, which avoids their conversion cost
+        start_frame, end_frame = 0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if window is not None:
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            start_frame = int(window[0] * fps)
+            end_frame = min(int(window[1] * fps), end_frame)
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+        for frame_num in range(start_frame, end_frame):
+            if (frame_num - start_frame) % stride != 0:
+                if not cap.grab():
                     break
+                continue
 
-            cap.release()
-            result.release()
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if scale != 1:
+                frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            yield frame_num, frame
 
-            # Closes all the frames
-            cv2.destroyAllWindows()
+    def get_cached_detection(self, detections, frame_num, scale=1.0):
+        # None means detect on the frame, False means the cache knows there is no board
+        if detections is None:
+            return None
+        if frame_num not in detections:
+            return False
+        return scale_detection(detections[frame_num], scale)
+
+    def label_calib_video(self, calib_vid, calib_label, camera_matrix, dist_coeff, stride=1, window=None, scale=1.0,
+                          detections=None):
+        cap, result = self.open_calib_video(calib_vid, calib_label, stride=stride, scale=scale)
+        camera_matrix = scale_camera_matrix(camera_matrix, scale)
+        for frame_num, frame in self.iter_calib_frames(cap, stride=stride, window=window, scale=scale):
+            detection = self.get_cached_detection(detections, frame_num, scale)
+            if detection is False:
+                result.write(frame)
+                continue
 
-    def get_calibration_board(self, config=None):
-        if config is None:
-            config = self.config
+            axis_frame = self.draw_axis(frame, camera_matrix, dist_coeff, self.boardObj, False, detection=detection)
 
-        calib = config['calibration']
+            if axis_frame is not None:
+                result.write(axis_frame)
+            else:
+                result.write(frame)
 
-        board_size = calib['board_size']
-        board_type = calib['board_type'].lower()
+        cap.release()
+        result.release()
 
-        if board_type == 'aruco':
-            raise NotImplementedError("aruco board is not implemented with the current pipeline")
-        elif board_type == 'charuco':
-            board = CharucoBoard(
-                board_size[0], board_size[1],
-                calib['board_square_side_length'],
-                calib['board_marker_length'],
-                calib['board_marker_bits'],
-                calib['board_marker_dict_number'])
+        # Closes all the frames
+        cv2.destroyAllWindows()
 
-        elif board_type == 'checkerboard':
-            board = Checkerboard(board_size[0], board_size[1],
-                                 calib['board_square_side_length'])
-        else:
-            raise ValueError("board_type should be one of "
-                             "'aruco', 'charuco', or 'checkerboard' not '{}'".format(
-                board_type))
+    def label_calib_video_parallel(self, calib_vid, calib_label, camera_matrix, dist_coeff, pool, batch_size=32,
+                                   max_pending=4, stride=1, window=None, scale=1.0, detections=None):
+        # Frames are read here in batches and labeled by the process pool. A writer thread
+        # waits on the batches in submission order, so the output keeps the frame order,
+        # and the bounded queue caps how many decoded frames are held in memory
+        cap, result = self.open_calib_video(calib_vid, calib_label, stride=stride, scale=scale)
+        camera_matrix = scale_camera_matrix(camera_matrix, scale)
+        frames = self.iter_calib_frames(cap, stride=stride, window=window, scale=scale)
+        pending = queue.Queue(maxsize=max_pending)
+        errors = []
 
-        return board
+        def write_batches():
+            while True:
+                future = pending.get()
+                if future is None:
+                    break
+                if len(errors) > 0:
+                    # Keep draining so the reader never blocks on a full queue
+                    continue
+                try:
+                    for frame in future.result():
+                        result.write(frame)
+                except Exception as e:
+                    errors.append(e)
 
-    def draw_axis(self, frame, camera_matrix, dist_coeff, boardObj=None, verbose=True):
-        if boardObj is None:
-            boardObj = self.boardObj
+        writer = threading.Thread(target=write_batches)
+        writer.start()
 
         try:
-            corners, ids, rejected_points = cv2.aruco.detectMarkers(frame, boardObj.dictionary, parameters=params)
-
-            if corners is None or ids is None:
-                print('No corner detected')
-                return None
-            if len(corners) != len(ids) or len(corners) == 0:
-                print('Incorrect corner or no corner detected!')
-                return None
-
-            corners, ids, rejectedCorners, recoveredIdxs = cv2.aruco.refineDetectedMarkers(frame, boardObj.board, corners, ids,
-                                                                                           rejected_points,
-                                                                                           camera_matrix,
-                                                                                           dist_coeff,
-                                                                                           parameters=params)
-
-            if len(corners) == 0:
-                return None
-
-            ret, c_corners, c_ids = cv2.aruco.interpolateCornersCharuco(corners, ids,
-                                                                        frame, boardObj.board,
-                                                                        cameraMatrix=camera_matrix,
-                                                                        distCoeffs=dist_coeff)
-
-            if c_corners is None or c_ids is None or len(c_corners) < 5:
-                print('No corner detected after interpolation!')
-                return None
-
-            n_corners = c_corners.size // 2
-            reshape_corners = np.reshape(c_corners, (n_corners, 1, 2))
-
-            ret, p_rvec, p_tvec = cv2.aruco.estimatePoseCharucoBoard(reshape_corners,
-                                                                     c_ids,
-                                                                     boardObj.board,
-                                                                     camera_matrix,
-                                                                     dist_coeff)
-
-            if p_rvec is None or p_tvec is None:
-                print('Cant detect rotation!')
-                return None
-            if np.isnan(p_rvec).any() or np.isnan(p_tvec).any():
-                print('Rotation is not usable')
-                return None
+            while len(errors) == 0:
+                batch = []
+                batch_detections = []
+                for frame_num, frame in frames:
+                    batch.append(frame)
+                    batch_detections.append(self.get_cached_detection(detections, frame_num, scale))
+                    if len(batch) == batch_size:
+                        break
+
+                if len(batch) > 0:
+                    pending.put(pool.submit(label_frame_batch, batch, camera_matrix, dist_coeff, batch_detections))
+                if len(batch) < batch_size:
+                    break
+        finally:
+            pending.put(None)
+            writer.join()
+            cap.release()
+            result.release()
 
-            cv2.aruco.drawAxis(image=frame, cameraMatrix=camera_matrix, distCoeffs=dist_coeff,
-                               rvec=p_rvec, tvec=p_tvec, length=20)
+        if len(errors) > 0:
+            raise errors[0]
+        print('Labeled ' + os.path.basename(calib_label))
+
+    def label_calib_sheet(self, calib_vid, sheet_fname, camera_matrix, dist_coeff, n_frames=16, window=None,
+                          scale=0.25, detections=None):
+        # Label a few evenly spaced frames and tile them into a single image for a quick check
+        cap = cv2.VideoCapture(calib_vid)
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        start_frame, end_frame = 0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if window is not None:
+            start_frame = int(window[0] * fps)
+            end_frame = min(int(window[1] * fps), end_frame)
+
+        camera_matrix = scale_camera_matrix(camera_matrix, scale)
+        tiles = []
+        for frame_num in np.linspace(start_frame, end_frame - 1, n_frames).astype(int):
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+            ret, frame = cap.read()
+            if not ret:
+                continue
+            if scale != 1:
+                frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            detection = self.get_cached_detection(detections, frame_num, scale)
+            axis_frame = None
+            if detection is not False:
+                axis_frame = self.draw_axis(frame, camera_matrix, dist_coeff, self.boardObj, False, detection=detection)
+            tile = axis_frame if axis_frame is not None else frame
+            cv2.putText(tile, '{:.2f} s'.format(frame_num / fps), (5, 20),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 255), 2)
+            tiles.append(tile)
+        cap.release()
+
+        if len(tiles) == 0:
+            print('No frame could be read from ' + calib_vid)
+            return
+
+        n_cols = int(np.ceil(np.sqrt(len(tiles))))
+        n_rows = int(np.ceil(len(tiles) / n_cols))
+        tiles += [np.zeros_like(tiles[0])] * (n_rows * n_cols - len(tiles))
+        sheet = np.vstack([np.hstack(tiles[row * n_cols:(row + 1) * n_cols]) for row in range(n_rows)])
+        cv2.imwrite(sheet_fname, sheet)
+        print('Saved contact sheet ' + os.path.basename(sheet_fname))
 
-            cv2.aruco.drawDetectedCornersCharuco(frame, reshape_corners, c_ids)
-            cv2.aruco.drawDetectedMarkers(frame, corners, ids)
-            # cv2.aruco.drawDetectedMarkers(frame, rejected_points, borderColor=(100, 0, 240))
+    def get_calibration_board(self, config=None):
+        if config is None:
+            config = self.config
 
-        except cv2.error as e:
-            exc_type, exc_obj, exc_tb = sys.exc_info()
-            fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-            print(exc_type, fname, exc_tb.tb_lineno, e)
-            return None
+        return get_calibration_board(config)
 
-        if verbose:
-            print('Translation : {0}'.format(p_tvec))
-            print('Rotation    : {0}'.format(p_rvec))
-            print('Distance from camera: {0} m'.format(np.linalg.norm(p_tvec)))
+    def draw_axis(self, frame, camera_matrix, dist_coeff, boardObj=None, verbose=True, detection=None):
+        if boardObj is None:
+            boardObj = self.boardObj
 
-        return frame
+        return draw_axis(frame, camera_matrix, dist_coeff, boardObj, verbose, detection=detection)
@@ -1,8 +1,121 @@
 from analysissupport.anipose_support.project_manager import ProjectManager
+from analysissupport.common import file_fingerprint, file_changed
 import sys, os
+import toml
 import numpy as np
 import pandas as pd
-
+from analysissupport.anipose_support.triangulation_utils import triangulate_dlt, reprojection_error_batch, \
+    TRIANGULATION_ENGINES
+from analysissupport.anipose_support.filter_utils import filter_pose3d_config
+
+# Arrays stored in the binary output folder and the DataManager attribute holding each one
+OUTPUT_ARRAYS = {
+    'points_3d': 'all_points_3d',
+    'errors': 'all_errors',
+    'scores_3d': 'scores_3d',
+    'num_cams': 'num_cams',
+}
+
+# Triangulation settings that do not change the triangulated values
+FINGERPRINT_IGNORED_KEYS = ['chunk_size', 'output_format', 'incremental']
+
+
+def is_binary_output(output_fname):
+    return not output_fname.endswith('.csv')
+
+
+class LazyPoseData:
+    """
+    Read-only access to a stored 3D result without loading the whole recording.
+
+    Binary outputs are memory-mapped, so only the requested frames and body parts are read
+    from disk. CSV outputs fall back to reading only the needed columns and rows.
+    frames can be a slice or a (start, stop) tuple, bodyparts a name or a list of names.
+    """
+    def __init__(self, output_fname):
+        self.output_fname = output_fname
+        self.binary = os.path.isdir(output_fname)
+
+        if self.binary:
+            metadata = toml.load(os.path.join(output_fname, 'metadata.toml'))
+            self.body_parts = metadata['bodyparts']
+            self._n_frames = metadata['n_frames']
+            self.M = np.array(metadata['M'], dtype='float64')
+            self.center = np.array(metadata['center'], dtype='float64')
+            self.arrays = {name: np.load(os.path.join(output_fname, name + '.npy'), mmap_mode='r')
+                           for name in OUTPUT_ARRAYS}
+        else:
+            header = pd.read_csv(output_fname, nrows=1)
+            self.body_parts = [c.replace('_error', '') for c in header.columns if '_error' in c]
+            self.M = np.array([[header.loc[0, 'M_{}{}'.format(i, j)] for j in range(3)] for i in range(3)])
+            self.center = np.array([header.loc[0, 'center_{}'.format(i)] for i in range(3)])
+            self._n_frames = None
+
+    @property
+    def n_frames(self):
+        # Counting rows of a CSV needs a pass over the file, so only do it on request
+        if self._n_frames is None:
+            self._n_frames = len(pd.read_csv(self.output_fname, usecols=['fnum']))
+        return self._n_frames
+
+    def get_frame_slice(self, frames):
+        if frames is None:
+            return slice(None)
+        if isinstance(frames, slice):
+            return frames
+        start, stop = frames
+        return slice(start, stop)
+
+    def get_bodypart_index(self, bodyparts):
+        if bodyparts is None:
+            return slice(None)
+        if isinstance(bodyparts, str):
+            bodyparts = [bodyparts]
+        index = [self.body_parts.index(bp) for bp in bodyparts]
+        if index == list(range(index[0], index[-1] + 1)):
+            # Contiguous body parts can be returned as a view instead of a copy
+            return slice(index[0], index[-1] + 1)
+        return index
+
+    def read_csv_columns(self, suffixes, frames, bodyparts):
+        frames = self.get_frame_slice(frames)
+        if bodyparts is None:
+            bodyparts = self.body_parts
+        elif isinstance(bodyparts, str):
+            bodyparts = [bodyparts]
+
+        start = frames.start or 0
+        columns = [bp + suffix for bp in bodyparts for suffix in suffixes]
+        nrows = None if frames.stop is None else frames.stop - start
+        data = pd.read_csv(self.output_fname, usecols=columns,
+                           skiprows=range(1, start + 1), nrows=nrows)
+        values = np.array(data.loc[:, columns], dtype='float64')
+        return values[::frames.step or 1].reshape(-1, len(bodyparts), len(suffixes))
+
+    def get_array(self, name, frames=None, bodyparts=None):
+        if self.binary:
+            return self.arrays[name][self.get_frame_slice(frames), self.get_bodypart_index(bodyparts)]
+
+        suffixes = {
+            'points_3d': ['_x', '_y', '_z'],
+            'errors': ['_error'],
+            'scores_3d': ['_score'],
+            'num_cams': ['_ncams'],
+        }[name]
+        values = self.read_csv_columns(suffixes, frames, bodyparts)
+        return values if name == 'points_3d' else values[:, :, 0]
+
+    def points_3d(self, frames=None, bodyparts=None):
+        return self.get_array('points_3d', frames=frames, bodyparts=bodyparts)
+
+    def errors(self, frames=None, bodyparts=None):
+        return self.get_array('errors', frames=frames, bodyparts=bodyparts)
+
+    def scores_3d(self, frames=None, bodyparts=None):
+        return self.get_array('scores_3d', frames=frames, bodyparts=bodyparts)
+
+    def num_cams(self, frames=None, bodyparts=None):
+        return self.get_array('num_cams', frames=frames, bodyparts=bodyparts)
 
 
 class DataManager(ProjectManager):
@@ -10,13 +123,35 @@ class DataManager(ProjectManager):
         for key, val in vars(ProjectManager).items():
             setattr(self, key, val)
 
-    def process_triangulate(self, config=None, out=None, score_threshold=0.5, over_write=True):
-        if out is None:
-            out = self.pose2d_fnames
-
+    def process_triangulate(self, config=None, out=None, score_threshold=0.5, over_write=True, chunk_size=None,
+                            incremental=None):
         if config is None:
             config = self.config
 
+        if chunk_size is None:
+            chunk_size = config['triangulation'].get('chunk_size', 0)
+
+        if incremental is None:
+            incremental = config['triangulation'].get('incremental', False)
+
+        self.input_fingerprint = None
+        if incremental:
+            if os.path.exists(self.output_fname) and not self.inputs_changed(config, score_threshold):
+                print('\nInputs did not change since the last triangulation. Skipping ...')
+                self.status_triangulate = True
+                self.load_data()
+                return
+            self.input_fingerprint = self.get_input_fingerprint(config, score_threshold)
+            # The fingerprint decides in incremental mode, an output made from other inputs is stale
+            if os.path.exists(self.output_fname):
+                print('\nInputs changed since the last triangulation.')
+                over_write = True
+
+        if out is None:
+            if not hasattr(self, 'pose2d_fnames'):
+                self.load_label_data()
+            out = self.pose2d_fnames
+
         if os.path.exists(self.output_fname):
             print('\nThe videos were triangulate before ...')
             if not over_write:
@@ -38,11 +173,13 @@ class DataManager(ProjectManager):
         # remove points that are below threshold
         points[self.all_scores < score_threshold] = np.nan
 
+        if chunk_size:
+            return self.process_triangulate_chunked(points, chunk_size, config=config)
+
         points_flat = points.reshape(self.n_cams, -1, 2)
         scores_flat = self.all_scores.reshape(self.n_cams, -1)
 
-        points_3d = self.cgroup.triangulate(points_flat, progress=True)
-        errors = self.cgroup.reprojection_error(points_3d, points_flat, mean=True)
+        points_3d, errors = self.triangulate_points(points_flat, config=config, progress=True)
         good_points = ~np.isnan(points[:, :, :, 0])
         self.all_scores[~good_points] = 2
 
@@ -65,16 +202,103 @@ class DataManager(ProjectManager):
 
         return self.all_points_3d, self.all_errors, self.body_parts
 
-    def optim_data(self, config=None):
+    def process_triangulate_chunked(self, points, chunk_size, config=None):
+        # Triangulate and score fixed windows of frames, appending each window to the
+        # output file as soon as it is done so that only one chunk of intermediates is alive
+        if config is None:
+            config = self.config
+
+        self.M = np.identity(3)
+        self.center = np.zeros(3)
+
+        binary_output = is_binary_output(self.output_fname)
+        if binary_output:
+            # Chunks are written straight into the memory-mapped output arrays
+            self.open_binary_output(self.output_fname)
+        else:
+            self.all_points_3d = np.full((self.n_frames, self.n_joints, 3), np.nan)
+            self.all_errors = np.full((self.n_frames, self.n_joints), np.nan)
+            self.num_cams = np.zeros((self.n_frames, self.n_joints))
+            self.scores_3d = np.full((self.n_frames, self.n_joints), np.nan)
+
+        n_chunks = int(np.ceil(self.n_frames / chunk_size))
+        for chunk_num, start in enumerate(range(0, self.n_frames, chunk_size)):
+            end = min(start + chunk_size, self.n_frames)
+            print('Triangulating frames {} to {} (chunk {}/{}) ...'.format(start, end - 1, chunk_num + 1, n_chunks))
+
+            points_chunk = points[:, start:end]
+            scores_chunk = self.all_scores[:, start:end]
+            points_flat = points_chunk.reshape(self.n_cams, -1, 2)
+
+            points_3d, errors = self.triangulate_points(points_flat, config=config, progress=False)
+            good_points = ~np.isnan(points_chunk[:, :, :, 0])
+            scores_chunk[~good_points] = 2
+
+            num_cams = np.sum(good_points, axis=0).astype('float')
+            points_3d = points_3d.reshape(end - start, self.n_joints, 3)
+            errors = errors.reshape(end - start, self.n_joints)
+            scores_3d = np.min(scores_chunk, axis=0)
+
+            scores_3d[num_cams < 2] = np.nan
+            errors[num_cams < 2] = np.nan
+            num_cams[num_cams < 2] = np.nan
+            self.mask_bad_points(points_3d, errors, config=config)
+
+            self.all_points_3d[start:end] = points_3d
+            self.all_errors[start:end] = errors
+            self.num_cams[start:end] = num_cams
+            self.scores_3d[start:end] = scores_3d
+
+            if binary_output:
+                for attr in OUTPUT_ARRAYS.values():
+                    getattr(self, attr).flush()
+            else:
+                dout = self.get_output_dataframe(start=start, end=end)
+                dout.to_csv(self.output_fname, mode='w' if start == 0 else 'a', header=(start == 0), index=False)
+
+        self.optim_data(config=config)
+        if binary_output:
+            for attr in OUTPUT_ARRAYS.values():
+                getattr(self, attr).flush()
+        self.dump_fingerprint(self.output_fname)
+
+        self.status_triangulate = True
+
+        return self.all_points_3d, self.all_errors, self.body_parts
+
+    def triangulate_points(self, points_flat, config=None, progress=True):
+        if config is None:
+            config = self.config
+
+        engine = config['triangulation'].get('engine', 'aniposelib')
+        if engine == 'aniposelib':
+            points_3d = self.cgroup.triangulate(points_flat, progress=progress)
+            errors = self.cgroup.reprojection_error(points_3d, points_flat, mean=True)
+        elif engine == 'dlt':
+            points_3d = triangulate_dlt(self.cgroup, points_flat)
+            errors = reprojection_error_batch(self.cgroup, points_3d, points_flat, mean=True)
+        else:
+            raise ValueError("triangulation engine should be one of "
+                             "{} not '{}'".format(TRIANGULATION_ENGINES, engine))
+
+        return points_3d, errors
+
+    def mask_bad_points(self, points_3d, errors, config=None):
         if config is None:
             config = self.config
 
         if config['triangulation']['optim']:
-            self.all_errors[np.isnan(self.all_errors)] = 0
+            errors[np.isnan(errors)] = 0
         else:
-            self.all_errors[np.isnan(self.all_errors)] = 10000
-        good = (self.all_errors < 100)
-        self.all_points_3d[~good] = np.nan
+            errors[np.isnan(errors)] = 10000
+        good = (errors < 100)
+        points_3d[~good] = np.nan
+
+    def optim_data(self, config=None):
+        if config is None:
+            config = self.config
+
+        self.mask_bad_points(self.all_points_3d, self.all_errors, config=config)
 
         self.all_points_flat = self.all_points_3d.reshape(-1, 3)
         check = ~np.isnan(self.all_points_flat[:, 0])
@@ -85,24 +309,174 @@ class DataManager(ProjectManager):
 
         self.low_points, self.high_points = np.percentile(self.all_points_flat[check], [1, 99], axis=0)
 
-    def export_data(self, output_fname=None, config=None):
+    def filter_data(self, config=None, output_fname=None):
+        # Reject high error points, fill short gaps and smooth, then export to output_fname.
+        # The filtered data is kept apart in self.filtered_data, this object keeps the
+        # triangulation as it is written to the main output
+        if config is None:
+            config = self.config
+
         if self.status_triangulate == False:
             print('The project is not triangulated. Please run process_triangulate first!')
             return
 
+        print('Filtering 3D data ...')
+        filtered = DataManager(self)
+        filtered.all_points_3d, filtered.all_errors, outliers = filter_pose3d_config(self.all_points_3d,
+                                                                                     self.all_errors, config)
+        # Only the main output is fingerprinted for the incremental triangulation
+        filtered.input_fingerprint = None
+        filtered.optim_data(config=config)
+
+        # Counted after optim_data, which masks the points it considers bad again
+        unfilled = np.sum(outliers & np.isnan(filtered.all_points_3d[:, :, 0]))
+        print('{} points rejected, {} of them not filled'.format(np.sum(outliers), unfilled))
+
         if output_fname is None:
-            output_fname = os.path.join(self.project_path, self.videos_tail + '.csv')
+            output_fname = self.get_filtered_output_fname(config=config)
+        os.makedirs(os.path.dirname(output_fname), exist_ok=True)
+        filtered.export_data(output_fname=output_fname, config=config)
+        filtered.output_fname = output_fname
+
+        self.filtered_data = filtered
+        return filtered.all_points_3d
+
+    def export_data(self, output_fname=None, config=None):
+        if self.status_triangulate == False:
+            print('The project is not triangulated. Please run process_triangulate first!')
+            return
 
         if config is None:
             config = self.config
 
+        if output_fname is None:
+            output_fname = self.get_output_fname(config=config)
+
+        if is_binary_output(output_fname):
+            self.export_binary(output_fname)
+        else:
+            dout = self.get_output_dataframe()
+            dout.to_csv(output_fname, index=False)
+
+        self.dump_fingerprint(output_fname)
+
+    def get_fingerprint_fname(self, output_fname=None):
+        if output_fname is None:
+            output_fname = self.output_fname
+        output_fname = output_fname.rstrip(os.sep)
+        if output_fname.endswith('.csv'):
+            output_fname = output_fname[:-len('.csv')]
+        return output_fname + '_fingerprint.toml'
+
+    def get_input_files(self):
+        files = list(self.get_pose2d_files().values())
+        files.append(os.path.join(self.calib_path, str("calibration.toml")))
+        return files
+
+    def get_triangulation_settings(self, config, score_threshold):
+        settings = {k: v for k, v in config['triangulation'].items() if k not in FINGERPRINT_IGNORED_KEYS}
+        settings['score_threshold_2d'] = score_threshold
+        # load_label_data filters the 2D points first when the filter is on
+        if config['filter'].get('enabled', False):
+            settings['filter_2d'] = {k: v for k, v in config['filter'].items() if k != 'multiprocessing'}
+        # Round trip through toml so the settings compare equal to the stored ones
+        return toml.loads(toml.dumps(settings))
+
+    def load_fingerprint(self, output_fname=None):
+        fname = self.get_fingerprint_fname(output_fname)
+        if not os.path.exists(fname):
+            return None
+        return toml.load(fname)
+
+    def get_input_fingerprint(self, config, score_threshold):
+        previous = self.load_fingerprint()
+        previous_files = previous['files'] if previous is not None else {}
+        return {
+            'files': {path: file_fingerprint(path, previous_files.get(path))
+                      for path in self.get_input_files()},
+            'triangulation': self.get_triangulation_settings(config, score_threshold),
+        }
+
+    def inputs_changed(self, config, score_threshold):
+        previous = self.load_fingerprint()
+        if previous is None:
+            return True
+
+        files = self.get_input_files()
+        if set(files) != set(previous['files'].keys()):
+            return True
+        mtimes = {path: previous['files'][path]['mtime'] for path in files}
+        if any(file_changed(path, previous['files'][path]) for path in files):
+            return True
+        if self.get_triangulation_settings(config, score_threshold) != previous['triangulation']:
+            return True
+
+        # Touched but identical files got their new mtime, store it so they are not hashed again
+        if any(previous['files'][path]['mtime'] != mtimes[path] for path in files):
+            with open(self.get_fingerprint_fname(), 'w') as toml_file:
+                toml.dump(previous, toml_file)
+        return False
+
+    def dump_fingerprint(self, output_fname):
+        # Only written once the output exists, so an interrupted run is never skipped
+        if getattr(self, 'input_fingerprint', None) is None:
+            return
+        with open(self.get_fingerprint_fname(output_fname), 'w') as toml_file:
+            toml.dump(self.input_fingerprint, toml_file)
+
+    def export_binary(self, output_dir):
+        # One .npy file per array plus a small metadata file, so loading needs no text parsing
+        self.dump_output_metadata(output_dir)
+        for name, attr in OUTPUT_ARRAYS.items():
+            array = getattr(self, attr)
+            fname = os.path.join(output_dir, name + '.npy')
+            if isinstance(array, np.memmap) and os.path.exists(fname) and os.path.samefile(array.filename, fname):
+                # Already backed by this file (chunked triangulation)
+                array.flush()
+                continue
+            np.save(fname, np.asarray(array, dtype='float64'))
+
+    def open_binary_output(self, output_dir):
+        # Create memory-mapped output arrays so chunks can be written straight to disk
+        self.dump_output_metadata(output_dir)
+
+        n_joints = len(self.body_parts)
+        shapes = {
+            'points_3d': (self.n_frames, n_joints, 3),
+            'errors': (self.n_frames, n_joints),
+            'scores_3d': (self.n_frames, n_joints),
+            'num_cams': (self.n_frames, n_joints),
+        }
+        for name, attr in OUTPUT_ARRAYS.items():
+            array = np.lib.format.open_memmap(os.path.join(output_dir, name + '.npy'), mode='w+',
+                                              dtype='float64', shape=shapes[name])
+            array[:] = np.nan
+            setattr(self, attr, array)
+
+    def dump_output_metadata(self, output_dir):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        metadata = {
+            'bodyparts': list(self.body_parts),
+            'n_frames': int(self.n_frames),
+            'M': np.asarray(self.M).tolist(),
+            'center': np.asarray(self.center).tolist(),
+        }
+        with open(os.path.join(output_dir, 'metadata.toml'), 'w') as toml_file:
+            toml.dump(metadata, toml_file)
+
+    def get_output_dataframe(self, start=0, end=None):
+        if end is None:
+            end = self.n_frames
+
         dout = pd.DataFrame()
         for bp_num, bp in enumerate(self.body_parts):
             for ax_num, axis in enumerate(['x', 'y', 'z']):
-                dout[bp + '_' + axis] = self.all_points_3d[:, bp_num, ax_num]
-            dout[bp + '_error'] = self.all_errors[:, bp_num]
-            dout[bp + '_ncams'] = self.num_cams[:, bp_num]
-            dout[bp + '_score'] = self.scores_3d[:, bp_num]
+                dout[bp + '_' + axis] = self.all_points_3d[start:end, bp_num, ax_num]
+            dout[bp + '_error'] = self.all_errors[start:end, bp_num]
+            dout[bp + '_ncams'] = self.num_cams[start:end, bp_num]
+            dout[bp + '_score'] = self.scores_3d[start:end, bp_num]
 
         for i in range(3):
             for j in range(3):
@@ -111,9 +485,9 @@ class DataManager(ProjectManager):
         for i in range(3):
             dout['center_{}'.format(i)] = self.center[i]
 
-        dout['fnum'] = np.arange(self.n_frames)
+        dout['fnum'] = np.arange(start, end)
 
-        dout.to_csv(output_fname, index=False)
+        return dout
 
     def load_data(self, config=None, output_fname=None):
         if output_fname is None:
@@ -127,6 +501,11 @@ class DataManager(ProjectManager):
         except KeyError:
             scheme = []
 
+        if os.path.isdir(output_fname):
+            self.load_binary(output_fname, scheme=scheme)
+            self.optim_data(config=config)
+            return
+
         data = pd.read_csv(output_fname)
         cols = [x for x in data.columns if '_error' in x]
 
@@ -159,3 +538,31 @@ class DataManager(ProjectManager):
 
         self.n_frames = np.max(data.loc[:, 'fnum']) + 1
         self.optim_data(config=config)
+
+    def load_binary(self, output_dir, scheme=None):
+        metadata = toml.load(os.path.join(output_dir, 'metadata.toml'))
+        stored_parts = metadata['bodyparts']
+
+        if scheme is None or len(scheme) == 0:
+            self.body_parts = stored_parts
+        else:
+            self.body_parts = sorted(set([x for dx in scheme for x in dx]))
+        bp_index = [stored_parts.index(bp) for bp in self.body_parts]
+
+        for name, attr in OUTPUT_ARRAYS.items():
+            array = np.load(os.path.join(output_dir, name + '.npy'))
+            setattr(self, attr, array[:, bp_index])
+
+        self.M = np.array(metadata['M'], dtype='float64')
+        self.center = np.array(metadata['center'], dtype='float64')
+        self.n_frames = metadata['n_frames']
+
+    def load_data_lazy(self, output_fname=None):
+        if output_fname is None:
+            output_fname = self.output_fname
+
+        self.lazy_data = LazyPoseData(output_fname)
+        self.body_parts = self.lazy_data.body_parts
+        self.M = self.lazy_data.M
+        self.center = self.lazy_data.center
+        return self.lazy_data
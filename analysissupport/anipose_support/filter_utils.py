@@ -0,0 +1,221 @@
+import os
+import numpy as np
+from scipy import ndimage, signal
+from scipy.interpolate import CubicSpline
+
+from analysissupport.common import EXECUTORS
+
+FILTER_TYPES = ['medfilt']
+SMOOTH_TYPES = ['savgol', 'none']
+
+# Score given to the points filled by the 2D filter, above any triangulation score threshold
+FILLED_SCORE = 1.0
+
+
+def medfilt_frames(values, kernel_size):
+    # scipy.signal.medfilt along the frame axis (axis 1) of every series at once, zero padded like medfilt
+    size = [1] * values.ndim
+    size[1] = kernel_size
+    return ndimage.median_filter(values, size=size, mode='constant', cval=0)
+
+
+def good_neighbors(bad):
+    # Previous and next good frame of every frame of (n_series, n_frames) masks, -1 / n_frames if there is none
+    n_frames = bad.shape[1]
+    frames = np.arange(n_frames)
+    prev = np.maximum.accumulate(np.where(~bad, frames, -1), axis=1)
+    nxt = np.minimum.accumulate(np.where(~bad, frames, n_frames)[:, ::-1], axis=1)[:, ::-1]
+    return prev, nxt
+
+
+def interpolate_linear(values, bad, prev, nxt):
+    # Linear fill of the bad frames from the given neighbors, constant past the ends like np.interp
+    n_frames = bad.shape[1]
+    prev_ok, next_ok = prev >= 0, nxt < n_frames
+    prev = np.where(prev_ok, prev, nxt)
+    nxt = np.where(next_ok, nxt, prev)
+
+    rows = np.arange(len(values))[:, None]
+    span = np.maximum(nxt - prev, 1)
+    weight = ((np.arange(n_frames) - prev) / span)[:, :, None]
+    filled = values[rows, prev] * (1 - weight) + values[rows, nxt] * weight
+    return np.where(bad[:, :, None], filled, values)
+
+
+def interpolate_gaps(values, bad, spline=True):
+    """
+    Fill the bad frames of many series at once.
+
+    values: (n_series, n_frames, n_dims), bad: (n_series, n_frames). As in anipose, only series
+    with some bad frames but more than half (and more than 5) good ones are filled, the others
+    keep NaN in the bad frames. Linear interpolation is fully vectorized, splines are fitted per
+    series (one vector-valued not-a-knot cubic, the same interpolant as splrep(k=3, s=0)).
+    """
+    n_series, n_frames = bad.shape
+    out = np.array(values, dtype='float64')
+    out[bad] = np.nan
+
+    n_good = np.sum(~bad, axis=1)
+    fill = np.any(bad, axis=1) & (n_good > 0.5 * n_frames) & (n_good > 5)
+    if not np.any(fill):
+        return out
+
+    frames = np.arange(n_frames)
+    if spline:
+        for s in np.flatnonzero(fill):
+            good = ~bad[s]
+            curve = CubicSpline(frames[good], out[s, good])
+            out[s, bad[s]] = curve(frames[bad[s]])
+        return out
+
+    sub_bad = bad[fill]
+    prev, nxt = good_neighbors(sub_bad)
+    out[fill] = interpolate_linear(out[fill], sub_bad, prev, nxt)
+    return out
+
+
+def filter_series(series, scores, kernel_size=13, offset_threshold=25, score_threshold=0.05, spline=True):
+    # series: (n_series, n_frames, 2), scores: (n_series, n_frames)
+    median = medfilt_frames(np.nan_to_num(series), kernel_size)
+    offset = np.sum(np.abs(series - median), axis=2)
+    bad = np.isnan(series[:, :, 0]) | (offset >= offset_threshold) | (scores < score_threshold)
+    filled = interpolate_gaps(series, bad, spline=spline)
+    return filled, bad & ~np.isnan(filled[:, :, 0])
+
+
+def filter_pose2d(points, scores, kernel_size=13, offset_threshold=25, score_threshold=0.05, spline=True,
+                  parallel=False, max_workers=None):
+    """
+    Median filter based 2D filtering of anipose on all cameras and joints at once.
+
+    points: (n_cams, n_frames, n_joints, 2), scores: (n_cams, n_frames, n_joints). A point is bad
+    when it is missing, its score is below score_threshold, or it jumps away from the median
+    filtered trajectory by offset_threshold pixels or more (|dx| + |dy|). Bad points are filled
+    by interpolate_gaps. With parallel, chunks of camera/joint series are filtered in a process pool.
+    Returns the filtered points and the scores, where the filled points get FILLED_SCORE so the
+    triangulation keeps them.
+    """
+    n_cams, n_frames, n_joints, _ = points.shape
+    params = dict(kernel_size=kernel_size, offset_threshold=offset_threshold,
+                  score_threshold=score_threshold, spline=spline)
+
+    # One series per camera and joint: (n_cams * n_joints, n_frames, 2)
+    series = points.transpose(0, 2, 1, 3).reshape(-1, n_frames, 2)
+    series_scores = scores.transpose(0, 2, 1).reshape(-1, n_frames)
+
+    if parallel and len(series) > 1:
+        n_chunks = min(max_workers or os.cpu_count() or 1, len(series))
+        chunks = np.array_split(np.arange(len(series)), n_chunks)
+        with EXECUTORS['process'](max_workers=max_workers) as pool:
+            futures = [pool.submit(filter_series, series[c], series_scores[c], **params) for c in chunks]
+            results = [future.result() for future in futures]
+        filled = np.concatenate([values for values, _ in results])
+        interpolated = np.concatenate([mask for _, mask in results])
+    else:
+        filled, interpolated = filter_series(series, series_scores, **params)
+
+    points_filtered = filled.reshape(n_cams, n_joints, n_frames, 2).transpose(0, 2, 1, 3)
+    scores_filtered = np.where(interpolated, FILLED_SCORE, series_scores)
+    scores_filtered = scores_filtered.reshape(n_cams, n_joints, n_frames).transpose(0, 2, 1)
+    return np.ascontiguousarray(points_filtered), np.ascontiguousarray(scores_filtered)
+
+
+def filter_pose2d_config(pose2d, config):
+    # Filter a load_pose2d_fnames style dict with the settings of config['filter']
+    params = config['filter']
+    if params.get('type', 'medfilt') not in FILTER_TYPES:
+        raise ValueError("filter type should be one of {} not '{}'".format(FILTER_TYPES, params['type']))
+
+    points, scores = filter_pose2d(pose2d['points'], pose2d['scores'],
+                                   kernel_size=params.get('medfilt', 13),
+                                   offset_threshold=params.get('offset_threshold', 25),
+                                   score_threshold=params.get('score_threshold', 0.05),
+                                   spline=params.get('spline', True),
+                                   parallel=params.get('multiprocessing', False))
+    filtered = dict(pose2d)
+    filtered['points'] = points
+    filtered['scores'] = scores
+    return filtered
+
+
+def fill_short_gaps(values, max_gap):
+    """
+    Linear interpolation of the NaN runs of at most max_gap frames inside each series.
+
+    values: (n_series, n_frames, n_dims). Longer gaps and gaps at the start or the end of a
+    series are left as NaN. Returns the filled copy and the mask of the frames still missing.
+    """
+    n_frames = values.shape[1]
+    missing = np.isnan(values[:, :, 0])
+    prev, nxt = good_neighbors(missing)
+    fill = missing & (prev >= 0) & (nxt < n_frames) & (nxt - prev - 1 <= max_gap)
+
+    out = np.array(values, dtype='float64')
+    rows = np.any(fill, axis=1)
+    if np.any(rows):
+        filled = interpolate_linear(out[rows], fill[rows], prev[rows], nxt[rows])
+        out[rows] = np.where(fill[rows][:, :, None], filled, out[rows])
+    return out, missing & ~fill
+
+
+def smooth_series(values, missing, window=11, order=3):
+    # Savitzky-Golay along the frames of every series at once. Missing frames are bridged
+    # linearly for the filter and set back to NaN after, series with no good frame stay NaN
+    n_frames = values.shape[1]
+    if window % 2 == 0:
+        window += 1
+    if n_frames < window or window <= order:
+        return values
+
+    smoothed = np.array(values, dtype='float64')
+    rows = ~np.all(missing, axis=1)
+    if not np.any(rows):
+        return smoothed
+
+    prev, nxt = good_neighbors(missing[rows])
+    bridged = interpolate_linear(np.nan_to_num(values[rows]), missing[rows], prev, nxt)
+    smoothed[rows] = signal.savgol_filter(bridged, window, order, axis=1)
+    smoothed[missing] = np.nan
+    return smoothed
+
+
+def filter_pose3d(points_3d, errors, error_threshold=10, max_gap=10, smooth='savgol', window=11, order=3):
+    """
+    Outlier rejection, gap filling and smoothing of triangulated points, all joints at once.
+
+    points_3d: (n_frames, n_joints, 3), errors: (n_frames, n_joints) reprojection errors.
+    Points with an error above error_threshold are dropped, gaps of at most max_gap frames are
+    interpolated, then each joint trajectory is smoothed. Filled points get the error
+    interpolated from their neighbors, so they are not masked again as points without error.
+    Returns the filtered points, their errors and the (n_frames, n_joints) mask of the outliers.
+    """
+    if smooth not in SMOOTH_TYPES:
+        raise ValueError("smooth should be one of {} not '{}'".format(SMOOTH_TYPES, smooth))
+
+    points = np.array(points_3d, dtype='float64')
+    outliers = np.nan_to_num(errors, nan=0) > error_threshold
+    points[outliers] = np.nan
+    point_missing = np.isnan(points[:, :, 0])
+
+    # One series per joint: (n_joints, n_frames, 3), and the errors with the same gaps
+    series = points.transpose(1, 0, 2)
+    series, missing = fill_short_gaps(series, max_gap)
+    error_series = np.where(point_missing, np.nan, np.nan_to_num(errors, nan=0)).T[:, :, None]
+    error_series, _ = fill_short_gaps(error_series, max_gap)
+    if smooth == 'savgol':
+        series = smooth_series(series, missing, window=window, order=order)
+
+    points_filtered = np.ascontiguousarray(series.transpose(1, 0, 2))
+    errors_filtered = np.ascontiguousarray(error_series[:, :, 0].T)
+    return points_filtered, errors_filtered, outliers
+
+
+def filter_pose3d_config(points_3d, errors, config):
+    # filter_pose3d with the settings of config['filter3d']
+    params = config['filter3d']
+    return filter_pose3d(points_3d, errors,
+                         error_threshold=params.get('reproj_error_threshold', 10),
+                         max_gap=params.get('max_gap', 10),
+                         smooth=params.get('smooth', 'savgol'),
+                         window=params.get('window', 11),
+                         order=params.get('order', 3))
@@ -1,5 +1,225 @@
-import os, sys, glob
+import os, sys
+import numpy as np
+import pandas as pd
 from aniposelib.utils import load_pose2d_fnames
+from analysissupport.common import EXECUTORS, match_cam_name
+from analysissupport.anipose_support.filter_utils import filter_pose2d_config
+
+
+def read_dlc_h5(fname):
+    """
+    Columns and values of a DeepLabCut .h5 file read straight from the HDF5 layout pandas uses,
+    without building the DataFrame and its MultiIndex.
+
+    Handles the 'table' format DeepLabCut writes and the default 'fixed' format, as long as
+    all the values are in one float block. Returns (columns, values) with columns a list of
+    label tuples and values a (n_frames, n_columns) array, or None for any other layout.
+    """
+    try:
+        import tables
+    except ImportError:
+        return None
+
+    with tables.open_file(fname, 'r') as f:
+        groups = list(f.root._v_groups.values())
+        if len(groups) == 0:
+            return None
+        group = groups[0]
+
+        if 'table' in group:
+            blocks = group._v_attrs.values_cols
+            if len(blocks) != 1:
+                return None
+            table = group.table
+            columns = [tuple(c) for c in table.attrs[blocks[0] + '_kind']]
+            values = table.col(blocks[0])
+        elif 'block0_values' in group:
+            if group._v_attrs.nblocks != 1 or group._v_attrs.block0_items_variety != 'multi':
+                return None
+            n_levels = group._v_attrs.block0_items_nlevels
+            levels = [[x.decode() if isinstance(x, bytes) else str(x)
+                       for x in group['block0_items_level{}'.format(i)].read()] for i in range(n_levels)]
+            labels = [group['block0_items_label{}'.format(i)].read() for i in range(n_levels)]
+            columns = list(zip(*[[levels[i][j] for j in labels[i]] for i in range(n_levels)]))
+            values = group.block0_values.read()
+        else:
+            return None
+
+    return columns, np.asarray(values, dtype='float64')
+
+
+def read_pose2d_table(fname):
+    # (columns, values) of a DeepLabCut file, through pandas if the layout is not a plain one.
+    # Only the first scorer is kept and the columns are reduced to (bodypart, coord)
+    data = read_dlc_h5(fname)
+    if data is None:
+        dlabs = pd.read_hdf(fname)
+        data = list(dlabs.columns), dlabs.to_numpy(dtype='float64')
+    columns, values = data
+
+    if len(columns[0]) > 2:
+        keep = [i for i, c in enumerate(columns) if c[0] == columns[0][0]]
+        if len(keep) < len(columns):
+            values = values[:, keep]
+        columns = [columns[i][1:] for i in keep]
+
+    return [tuple(c[-2:]) for c in columns], values
+
+
+def fill_pose2d(points, scores, joint_names, columns, values):
+    # Copy one camera's values into its (n_frames, n_joints, 2) points and (n_frames, n_joints)
+    # scores. Body parts missing from the file are left as they are
+    n_frames = points.shape[0]
+    regular = [(joint, coord) for joint in joint_names for coord in ['x', 'y', 'likelihood']]
+    if columns == regular:
+        # The layout DeepLabCut writes, a reshape is enough
+        block = values[:n_frames].reshape(n_frames, len(joint_names), 3)
+        points[:] = block[:, :, :2]
+        scores[:] = block[:, :, 2]
+        return
+
+    joint_index = {joint: i for i, joint in enumerate(joint_names)}
+    for col, (joint, coord) in enumerate(columns):
+        if joint not in joint_index:
+            continue
+        if coord == 'x':
+            points[:, joint_index[joint], 0] = values[:n_frames, col]
+        elif coord == 'y':
+            points[:, joint_index[joint], 1] = values[:n_frames, col]
+        elif coord == 'likelihood':
+            scores[:, joint_index[joint]] = values[:n_frames, col]
+
+
+def load_pose2d_fast(fname_dict, cam_names=None, executor=None, max_workers=None):
+    """
+    Same output as aniposelib's load_pose2d_fnames: the DeepLabCut files are read with
+    read_dlc_h5 and copied straight into one preallocated (n_cams, n_frames, n_joints, 2)
+    array. With executor='process' the cameras are read in parallel, which pays off on
+    network drives. PyTables is not thread-safe, so threads are not an option here.
+    """
+    if cam_names is None:
+        cam_names = sorted(fname_dict.keys())
+    pose_names = [fname_dict[cname] for cname in cam_names]
+
+    if executor is None or len(pose_names) < 2:
+        datas = [read_pose2d_table(fname) for fname in pose_names]
+    else:
+        with EXECUTORS[executor](max_workers=max_workers or len(pose_names)) as pool:
+            datas = list(pool.map(read_pose2d_table, pose_names))
+
+    # Body parts of the last camera, as in load_pose2d_fnames
+    joint_names = list(dict.fromkeys(joint for joint, coord in datas[-1][0]))
+    n_cams = len(cam_names)
+    n_joints = len(joint_names)
+    n_frames = min([values.shape[0] for columns, values in datas])
+
+    points = np.full((n_cams, n_frames, n_joints, 2), np.nan, 'float')
+    scores = np.zeros((n_cams, n_frames, n_joints), 'float')
+    for cam_ix, (columns, values) in enumerate(datas):
+        fill_pose2d(points[cam_ix], scores[cam_ix], joint_names, columns, values)
+
+    return {
+        'cam_names': cam_names,
+        'points': points,
+        'scores': scores,
+        'bodyparts': joint_names
+    }
+
+
+def get_video_cams(videos, cam_names):
+    # Camera of every video from its name. Falls back to the order of the videos when the names do not tell
+    cam_videos = dict()
+    for video in videos:
+        cam_name = match_cam_name(os.path.basename(video), cam_names)
+        if cam_name is not None and cam_name not in cam_videos:
+            cam_videos[cam_name] = video
+
+    if len(cam_videos) == 0:
+        cam_videos = dict(zip(cam_names, videos))
+    return cam_videos
+
+
+def find_pose_candidates(video, names, extension='.h5'):
+    """
+    DeepLabCut outputs of a video among the file names of its folder, as (scorer, filtered, name).
+
+    DeepLabCut names them <video stem><scorer>[_filtered]<extension>. Files that belong to a
+    longer video name starting with the same stem (cam1_trial2 for cam1_trial) are left out.
+    """
+    base = os.path.basename(video)
+    stem, video_ext = os.path.splitext(base)
+    longer_stems = [os.path.splitext(n)[0] for n in names
+                    if n != base and n.endswith(video_ext) and n.startswith(stem)]
+
+    candidates = []
+    for name in names:
+        if not name.startswith(stem) or not name.endswith(extension):
+            continue
+        if any(name.startswith(other) for other in longer_stems):
+            continue
+        rest = name[len(stem):len(name) - len(extension)]
+        filtered = rest.endswith('_filtered')
+        scorer = rest[:-len('_filtered')] if filtered else rest
+        candidates.append((scorer, filtered, name))
+    return candidates
+
+
+def match_pose_files(videos, cam_names, listings, scorer='', filtered=False, extension='.h5'):
+    """
+    Resolve the DeepLabCut output of every camera: the one with the wanted filtered flag and
+    extension, whose scorer contains scorer, and with the same scorer for all cameras.
+
+    listings maps each video folder to the file names in it. When several scorers fit, the
+    one shared by all cameras with the newest files is used and the others are reported.
+    Cameras without a matching output are left out of the returned {cam name: path} dict.
+    """
+    cam_videos = get_video_cams(videos, cam_names)
+
+    candidates = dict()
+    for cam_name, video in cam_videos.items():
+        folder = os.path.normpath(os.path.dirname(video))
+        names = listings.get(folder, [])
+        candidates[cam_name] = {s: os.path.join(folder, name)
+                                for s, f, name in find_pose_candidates(video, names, extension)
+                                if f == filtered and scorer in s}
+
+    def newest(paths):
+        return max(os.path.getmtime(path) for path in paths)
+
+    found = [c for c in cam_names if len(candidates.get(c, {})) > 0]
+    common = set.intersection(*[set(candidates[c]) for c in found]) if len(found) > 0 else set()
+
+    result = dict()
+    if len(common) > 0:
+        chosen = max(sorted(common), key=lambda s: newest([candidates[c][s] for c in found]))
+        if len(common) > 1:
+            print('Several scorers match, using {} (others: {})'.format(chosen, sorted(common - {chosen})))
+        result = {c: candidates[c][chosen] for c in found}
+    elif len(found) > 0:
+        print('The cameras do not share a scorer, using the newest output of each camera')
+        for c in found:
+            result[c] = max(candidates[c].values(), key=os.path.getmtime)
+
+    missing = [c for c in cam_names if c not in result]
+    if len(missing) > 0:
+        print('No {}{} pose file found for: {}'.format('filtered ' if filtered else '', extension, missing))
+
+    return result
+
+
+def dump_pose2d_npz(fname, pose2d):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    np.savez(fname, points=pose2d['points'], scores=pose2d['scores'],
+             bodyparts=np.array(pose2d['bodyparts']), cam_names=np.array(pose2d['cam_names']))
+
+
+def load_pose2d_npz(fname):
+    with np.load(fname) as data:
+        return {'points': data['points'],
+                'scores': data['scores'],
+                'bodyparts': data['bodyparts'].tolist(),
+                'cam_names': data['cam_names'].tolist()}
+
 
 class LabelManager:
     def __init__(self, ProjectManager=None) -> None:
@@ -9,16 +229,21 @@ class LabelManager:
         self.labeled_video_check = True
 
     def create_pose_dict(self):
-        # create video dict with cam names
+        # create video dict with cam names, from one listing of each video folder
+        labeling = self.config.get('labeling', {})
+        cam_names = self.cgroup.get_names()
+
+        listings = dict()
+        for folder in set(os.path.normpath(os.path.dirname(v)) for v in self.videos_pair):
+            with os.scandir(folder) as entries:
+                listings[folder] = sorted(entry.name for entry in entries)
 
-        videos = [
-            glob.glob(os.path.join(self.videos_pair[i].replace('.avi', '') + "*" + ".h5"))
-            for i in range(len(self.videos_pair))
-        ]
-        videos = [y for x in videos for y in x]
-        self.videos_result = dict(zip(self.cgroup.get_names(), videos))
+        self.videos_result = match_pose_files(self.videos_pair, cam_names, listings,
+                                              scorer=labeling.get('scorer', ''),
+                                              filtered=labeling.get('filtered', False),
+                                              extension=labeling.get('pose_extension', '.h5'))
 
-        if len(videos) == 0:
+        if len(self.videos_result) < len(cam_names):
             self.labeled_video_check = False
 
         return self.videos_result
@@ -31,9 +256,28 @@ class LabelManager:
                 videos_result = self.create_pose_dict()
                 self.videos_result = videos_result
 
-        self.pose2d_fnames = load_pose2d_fnames(videos_result)
+        labeling = self.config.get('labeling', {})
+        if labeling.get('fast_reader', True):
+            self.pose2d_fnames = load_pose2d_fast(videos_result,
+                                                  executor=labeling.get('read_executor', '') or None,
+                                                  max_workers=labeling.get('read_workers', 0) or None)
+        else:
+            self.pose2d_fnames = load_pose2d_fnames(videos_result)
         return self.pose2d_fnames
 
+    def filter_pose2D(self, pose2d=None, output_fname=None):
+        # Filter the 2D data with config['filter'] and keep a copy in the pose_2d_filter folder
+        if pose2d is None:
+            pose2d = self.pose2d_fnames
+        if output_fname is None:
+            output_fname = os.path.join(self.project_path, self.config['pipeline']['pose_2d_filter'],
+                                        self.videos_tail + '.npz')
+
+        print('Filtering 2D data ...')
+        self.pose2d_filtered = filter_pose2d_config(pose2d, self.config)
+        dump_pose2d_npz(output_fname, self.pose2d_filtered)
+        return self.pose2d_filtered
+
     def analyze_pose2D(self):
         pass
 
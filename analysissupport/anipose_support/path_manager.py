@@ -1,9 +1,17 @@
 import os
 import csv
 from pathlib import Path
-import glob
+import time
+import toml
+import shutil
+import traceback
+from collections import defaultdict
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
 
-from analysissupport.anipose_support.project_manager import ProjectManager
+from analysissupport.anipose_support.project_manager import ProjectManager, DEFAULT_CONFIG
+from analysissupport.anipose_support.label_manager import match_pose_files
+from analysissupport.common import EXECUTORS, match_cam_name
 # from project_manager import *
 
 # from deeplabcut.utils import auxiliaryfunctions
@@ -13,13 +21,63 @@ videofile_pathlist = ['/Volumes/GoogleDrive/My Drive/Rat/Treadmill test /rat i0/
                        '/Volumes/GoogleDrive/My Drive/Rat/Treadmill test /rat-e/vids/11-6']
 model_folder = '/Users/sam/Downloads/TWO_CAM_FOR_SAM/R11_treadmill/'
 
+# Files of every scanned folder, reused until the folder mtime changes
+FOLDER_CACHE = dict()
+
+# Written in every scanned folder, see PathManager.scan_folder
+MANIFEST_NAME = 'manifest.toml'
+
+def triangulate_project(project, over_write=True):
+    # Runs inside a worker process. Errors are returned instead of raised so one
+    # bad session does not take down the whole batch. The result is written to the
+    # output file and only its name and number of frames are sent back, the parent
+    # loads the data when it is used
+    start = time.time()
+    try:
+        project.get_output_fname()
+        project.process_triangulate(over_write=over_write)
+        project.export_data()
+        result = {'output_fname': project.data_object.output_fname, 'n_frames': int(project.data_object.n_frames)}
+        return result, None, time.time() - start
+    except Exception:
+        return None, traceback.format_exc(), time.time() - start
+
+
+def convert_manifest_paths(manifest, convert):
+    # Copy of a manifest with convert applied to each of its file paths
+    converted = dict(manifest)
+    converted['videos_pair'] = [[convert(video) for video in videos] for videos in manifest['videos_pair']]
+    converted['videos_calib'] = [convert(video) for video in manifest['videos_calib']]
+    converted['calib_path'] = convert(manifest['calib_path'])
+    converted['projects'] = {tail: dict(files, pose_2d={cam_name: convert(fname)
+                                                        for cam_name, fname in files['pose_2d'].items()})
+                             for tail, files in manifest['projects'].items()}
+    return converted
+
+
+def print_batch_summary(summary):
+    header = '{:<40} {:<8} {:>10} {:>10}'.format('Project', 'Status', 'Frames', 'Time (s)')
+    print('\n' + header)
+    print('-' * len(header))
+    for row in summary:
+        print('{:<40} {:<8} {:>10} {:>10.1f}'.format(str(row['project'])[:40],
+                                                     row['status'],
+                                                     str(row['n_frames']),
+                                                     row['time']))
+    n_failed = sum(row['status'] != 'done' for row in summary)
+    print('-' * len(header))
+    print('{} succeeded, {} failed'.format(len(summary) - n_failed, n_failed))
+
+
 class PathManager:
     def __init__(self,
                  videofile_pathList,
                  videotype='.avi',
                  cam_names=['cam1', 'cam2'],
                  calib_name ='calib',
-                 model_folder=None) -> None:
+                 model_folder=None,
+                 lazy=True,
+                 manifest=True) -> None:
         self.projectList = []
         self.videotype = videotype
         self.cam_names = cam_names
@@ -31,8 +89,9 @@ class PathManager:
 
         print('\nInitializing project path list ...')
         for folder in self.videofile_pathList:         
-            videos_pair, videos_tail = self.get_camerawise_videos(folder)
-            videos_calib, calib_path = self.get_calib_videos(folder)
+            folder_manifest = self.scan_folder(folder, use_manifest=manifest)
+            videos_pair, videos_tail = folder_manifest['videos_pair'], folder_manifest['videos_tail']
+            videos_calib, calib_path = folder_manifest['videos_calib'], folder_manifest['calib_path']
             print('\nCurrent folder: ')
             print(folder)
             print('List of calib videos: ')
@@ -52,7 +111,11 @@ class PathManager:
                                                     videos_tail=videos_tail[idx],
                                                     videos_calib=videos_calib,
                                                     calib_path=calib_path,
-                                                    video_type=self.videotype)
+                                                    video_type=self.videotype,
+                                                    lazy=lazy)
+                    pose_2d = folder_manifest['projects'][videos_tail[idx]]['pose_2d']
+                    if len(pose_2d) == len(cam_names):
+                        currentProject.pose2d_files = {cam_name: pose_2d[cam_name] for cam_name in cam_names}
                     self.projectList.append(currentProject)
 
         print('\nTotal processing projects are: ' + str(len(self.projectList)))
@@ -72,7 +135,10 @@ class PathManager:
                                             video_type=self.videotype)
             self.projectList.append(currentProject)
 
-    def batch_triangulate(self, over_write=True):
+    def batch_triangulate(self, over_write=True, parallel=False, max_workers=None):
+        if parallel:
+            return self.batch_triangulate_parallel(over_write=over_write, max_workers=max_workers)
+
         print('\nTriangulating available projects ...')
         for project in self.projectList:
 
@@ -82,6 +148,87 @@ class PathManager:
 
         print('\nTriangulation done!')
 
+    def batch_triangulate_parallel(self, over_write=True, max_workers=None):
+        print('\nTriangulating available projects in parallel ...')
+        n_projects = len(self.projectList)
+        summary = []
+
+        # Calibrate lazy projects here one at a time, so the workers of projects sharing
+        # a calibration folder do not all calibrate it at once
+        for project in self.projectList:
+            project.initialize()
+
+        def report(project, result):
+            output, error, elapsed = result
+            count = len(summary) + 1
+            row = {'project': project.videos_tail, 'time': elapsed, 'error': error}
+            if error is None:
+                # Data of an earlier run is stale, the new output is loaded on first use
+                project.__dict__.pop('data_object', None)
+                project.output_fname = output['output_fname']
+                project.status_triangulate = True
+                row['status'] = 'done'
+                row['n_frames'] = output['n_frames']
+                print('[{}/{}] {} done in {:.1f} s'.format(count, n_projects, project.videos_tail, elapsed))
+            else:
+                row['status'] = 'failed'
+                row['n_frames'] = '-'
+                print('[{}/{}] {} failed:'.format(count, n_projects, project.videos_tail))
+                print(error)
+            summary.append(row)
+
+        # A worker dying (e.g. out of memory) breaks the whole pool and fails every pending
+        # project with it. The unfinished ones are run again in a fresh pool, and once a
+        # round finishes nothing, one process each so only the culprit fails
+        pending = list(self.projectList)
+        while len(pending) > 0:
+            n_pending = len(pending)
+            pending = self.triangulate_in_pool(pending, over_write, max_workers, report)
+            if len(pending) == n_pending:
+                break
+            if len(pending) > 0:
+                print('A worker process died, running the {} unfinished projects again ...'.format(len(pending)))
+
+        for project in pending:
+            print('Running {} in its own process ...'.format(project.videos_tail))
+            if len(self.triangulate_in_pool([project], over_write, 1, report)) > 0:
+                report(project, (None, 'The worker process died (e.g. out of memory or a crash)', 0.0))
+
+        print_batch_summary(summary)
+        print('\nTriangulation done!')
+        return summary
+
+    def triangulate_in_pool(self, projects, over_write, max_workers, report):
+        # Reports the projects that finished, returns the ones left when the pool broke
+        unfinished = []
+        with EXECUTORS['spawn'](max_workers=max_workers) as pool:
+            futures = {pool.submit(triangulate_project, project, over_write): project
+                       for project in projects}
+
+            for future in as_completed(futures):
+                project = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    unfinished.append(project)
+                    continue
+                except Exception:
+                    # The project could not be sent to or back from the worker
+                    result = None, traceback.format_exc(), 0.0
+                report(project, result)
+
+        return [project for project in projects if project in unfinished]
+
+    def batch_run_pipeline(self, targets=None, force=()):
+        print('\nRunning the pipeline of available projects ...')
+        for project in self.projectList:
+
+            print('\nProject ' + str(project.videos_tail))
+            project.run_pipeline(targets=targets, force=force)
+            print('Done')
+
+        print('\nPipeline done!')
+
     def batch_plot_data(self):
         print('\nPlotting triangulated project ...')
         for project in self.projectList:
@@ -100,61 +247,149 @@ class PathManager:
             project.export_data()
             print('Done')
 
+    def scan_folder(self, folder, use_manifest=True):
+        # Video pairs, calibration videos and 2D pose files of the projects of a folder. With
+        # use_manifest the result is kept in the folder's manifest.toml and the folder is only
+        # scanned again once its mtime or the one of its calibration folder changed (files
+        # added, removed or renamed). Whether a project is done is left to its own output and
+        # input fingerprint, which a folder listing cannot tell
+        settings = {'videotype': self.videotype, 'cam_names': list(self.cam_names), 'calib_name': self.calib_names,
+                    'labeling': self.get_labeling_settings(folder), 'relative_paths': True}
+        if use_manifest:
+            manifest = self.load_manifest(folder)
+            if manifest is not None and manifest.get('settings') == settings \
+                    and manifest.get('mtimes') == self.get_folder_mtimes(folder):
+                return manifest
+
+        videos_pair, videos_tail = self.get_camerawise_videos(folder)
+        projects = {tail: self.get_project_files(folder, video, tail) for video, tail in zip(videos_pair, videos_tail)}
+        # Last, since moving the calibration videos changes the folder
+        videos_calib, calib_path = self.get_calib_videos(folder)
+
+        manifest = {'settings': settings,
+                    'videos_pair': videos_pair,
+                    'videos_tail': videos_tail,
+                    'videos_calib': videos_calib,
+                    'calib_path': calib_path,
+                    'projects': projects}
+        if use_manifest:
+            self.dump_manifest(folder, manifest)
+        return manifest
+
+    def get_project_files(self, folder, videos, tail):
+        # 2D pose files of every camera, matched as in LabelManager.create_pose_dict
+        files = self.list_folder(folder)
+        labeling = self.get_labeling_settings(folder)
+        pose_2d = match_pose_files(videos, self.cam_names, {os.path.normpath(folder): sorted(files)},
+                                   scorer=labeling['scorer'], filtered=labeling['filtered'],
+                                   extension=labeling['pose_extension'])
+        return {'pose_2d': pose_2d}
+
+    def get_labeling_settings(self, folder):
+        # Pose file settings of the folder's config.toml, which its projects will use
+        labeling = dict(DEFAULT_CONFIG['labeling'])
+        fname = os.path.join(folder, 'config.toml')
+        if os.path.exists(fname):
+            labeling.update(toml.load(fname).get('labeling', {}))
+        return {k: labeling[k] for k in ['scorer', 'filtered', 'pose_extension']}
+
+    def load_manifest(self, folder):
+        fname = os.path.join(folder, MANIFEST_NAME)
+        if not os.path.exists(fname):
+            return None
+        try:
+            manifest = toml.load(fname)
+            return convert_manifest_paths(manifest, lambda path: os.path.join(folder, path))
+        except (toml.TomlDecodeError, OSError, KeyError, TypeError):
+            return None
+
+    def dump_manifest(self, folder, manifest):
+        # Creating the file changes the folder mtime, rewriting it does not. So the file is
+        # created first and the mtime recorded after, or the next scan would never reuse it.
+        # Paths are kept relative to the folder, so a copied or remounted folder still points
+        # at its own files
+        fname = os.path.join(folder, MANIFEST_NAME)
+        if not os.path.exists(fname):
+            open(fname, 'w').close()
+        manifest['mtimes'] = self.get_folder_mtimes(folder)
+        with open(fname, 'w') as f:
+            toml.dump(convert_manifest_paths(manifest, lambda path: os.path.relpath(path, folder)), f)
+
+    def get_folder_mtimes(self, folder, calib_foldername='calibration'):
+        # The calibration videos and results live in a subfolder, whose changes do not show
+        # in the mtime of the session folder
+        calib_path = os.path.join(folder, calib_foldername)
+        return {'folder': os.stat(folder).st_mtime_ns,
+                'calibration': os.stat(calib_path).st_mtime_ns if os.path.isdir(calib_path) else 0}
+
+    def list_folder(self, path):
+        # Entries of a folder by name, from one os.scandir. Cached until the folder
+        # mtime changes, since every listing is a round trip on network drives
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return dict()
+
+        cached = FOLDER_CACHE.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with os.scandir(path) as entries:
+            files = {entry.name: entry.path for entry in entries}
+
+        FOLDER_CACHE[path] = (mtime, files)
+        return files
+
+    def get_video_index(self, path):
+        # Videos of a folder keyed by (cam name, tail), where the tail is the rest of the file
+        # name, e.g. cam1_trial2.avi -> ('cam1', '_trial2.avi')
+        index = dict()
+        for name, file_path in self.list_folder(path).items():
+            if not name.endswith(self.videotype):
+                continue
+            cam_name = match_cam_name(name, self.cam_names)
+            if cam_name is not None:
+                index[(cam_name, name[len(cam_name):])] = file_path
+
+        return index
+
     def get_camerawise_videos(self, path):
-        # Find videos only specific to the cam names
-        videos = [
-            glob.glob(os.path.join(path, str(self.cam_names[i] + "*" + self.videotype)))
-            for i in range(len(self.cam_names))
-        ]
-        videos = [y for x in videos for y in x]
-
-        videomatch_list = videos.copy()
-        videomatch_list = list(map(lambda x: x.replace(self.cam_names[0],'').replace(self.cam_names[1],''), videomatch_list))
-        videotail_list = {x for x in videomatch_list if videomatch_list.count(x) > 1}
-        videotail_list = [os.path.basename(x) for x in videotail_list]
-
-        videospair_list = [
-            [os.path.join(path, str(self.cam_names[i] + videotail_list[x]))
-            for i in range(len(self.cam_names))]
-            for x in range(len(videotail_list))
-        ]
-
-        videotail_list = list(map(lambda x: x.replace('.avi', ''), videotail_list))
+        # Videos recorded by every camera with the same tail, calibration videos excluded
+        cams_per_tail = defaultdict(set)
+        for cam_name, tail in self.get_video_index(path):
+            if self.calib_names not in tail:
+                cams_per_tail[tail].add(cam_name)
+
+        videotail_list = sorted(tail for tail, cams in cams_per_tail.items() if len(cams) == len(self.cam_names))
+        videospair_list = [[os.path.join(path, cam_name + tail) for cam_name in self.cam_names]
+                           for tail in videotail_list]
+
+        videotail_list = [tail[:-len(self.videotype)] for tail in videotail_list]
         return videospair_list, videotail_list
 
-    def get_calib_videos(self, path, calib_foldername='calibration'):
+    def find_calib_videos(self, index):
+        # First calibration video of every camera that has one
         videos = []
         for cam_name in self.cam_names:
-            current_video = glob.glob(os.path.join(path, str(cam_name + "*" + self.calib_names + "*" + self.videotype)))
-            if len(current_video) > 0:
-                videos.append(current_video[0])
-        # videos = [
-        #     glob.glob(os.path.join(path, str("*" + self.calib_names + "*" + self.videotype)))
-        # ]
-        # videos = [y for x in videos for y in x]
+            tails = sorted(tail for cam, tail in index if cam == cam_name and self.calib_names in tail)
+            if len(tails) > 0:
+                videos.append(index[(cam_name, tails[0])])
+        return videos
 
+    def get_calib_videos(self, path, calib_foldername='calibration'):
         calib_path = os.path.join(path, calib_foldername)
+        videos = self.find_calib_videos(self.get_video_index(path))
 
         if len(videos) > 0:
-            import shutil
-
             if not os.path.exists(calib_path):
                 os.makedirs(calib_path)
 
             if os.path.exists(calib_path):
                 for calib_video in videos:
                     shutil.move(calib_video, calib_path)
-        
+                videos = [os.path.join(calib_path, os.path.basename(x)) for x in videos]
         else:
-            # videos = [
-            #     glob.glob(os.path.join(calib_path, str("*" + self.calib_names + "*" + self.videotype)))
-            # ]
-            # videos = [y for x in videos for y in x]
-            for cam_name in self.cam_names:
-                current_video = glob.glob(os.path.join(calib_path, str(cam_name + "*" + self.calib_names + "*" + self.videotype)))
-                if len(current_video) > 0:
-                    videos.append(current_video[0])
-
+            videos = self.find_calib_videos(self.get_video_index(calib_path))
 
         return videos, calib_path
 
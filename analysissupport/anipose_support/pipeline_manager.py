@@ -0,0 +1,244 @@
+from analysissupport.anipose_support.data_manager import FINGERPRINT_IGNORED_KEYS
+from analysissupport.anipose_support.label_manager import dump_pose2d_npz, load_pose2d_npz
+from analysissupport.common import file_fingerprint
+import os
+import shutil
+import toml
+import numpy as np
+
+# Calibration settings that do not change the calibration itself
+CALIBRATION_IGNORED_KEYS = ['registry', 'rig', 'detection_cache', 'label_parallel', 'label_workers',
+                            'label_batch_size', 'label_stride', 'label_window', 'label_scale',
+                            'label_contact_sheet', 'label_sheet_scale']
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    upstream: names of the stages whose outputs this stage reads
+    config: function returning the settings the result depends on
+    inputs: function returning the files read besides the upstream outputs
+    outputs: function returning the files or folders written
+    run: computes the outputs, load: puts cached outputs back on the project
+    enabled: function telling if the stage runs at all, disabled stages pass their upstream through
+    """
+    def __init__(self, name, upstream=(), config=None, inputs=None, outputs=None, run=None, load=None,
+                 enabled=None) -> None:
+        self.name = name
+        self.upstream = list(upstream)
+        self.config = config if config is not None else lambda: {}
+        self.inputs = inputs if inputs is not None else lambda: []
+        self.outputs = outputs if outputs is not None else lambda: []
+        self.run = run
+        self.load = load if load is not None else lambda: None
+        self.enabled = enabled if enabled is not None else lambda: True
+
+
+def path_fingerprint(path):
+    # Size and mtime of a file, or of every file in a folder
+    if os.path.isdir(path):
+        return {name: file_fingerprint(os.path.join(path, name), content_hash=False)
+                for name in sorted(os.listdir(path)) if os.path.isfile(os.path.join(path, name))}
+    return file_fingerprint(path, content_hash=False)
+
+
+class PipelineManager:
+    """
+    Stage graph of a project: calibrate -> load_2d -> filter_2d -> triangulate -> filter -> export -> plot.
+
+    Every stage records in <tail>_pipeline.toml the settings, input files and upstream outputs
+    it was computed from, plus the fingerprints of its own outputs. A stage is only run again
+    when one of these changed or an output is missing, otherwise its cached outputs are reused
+    and only loaded when a later stage has to run.
+    """
+    def __init__(self, ProjectManager) -> None:
+        self.project = ProjectManager
+        self.config = ProjectManager.config
+        self.stages = self.build_stages()
+        self.loaded = set()
+
+    def build_stages(self):
+        stages = [
+            Stage('calibrate',
+                  config=lambda: {k: v for k, v in self.config['calibration'].items()
+                                  if k not in CALIBRATION_IGNORED_KEYS},
+                  inputs=lambda: self.project.videos_calib,
+                  outputs=lambda: [os.path.join(self.project.calib_path, 'calibration.toml')],
+                  run=self.run_calibrate,
+                  load=self.project.initialize),
+            Stage('load_2d',
+                  inputs=lambda: list(self.project.get_pose2d_files().values()),
+                  outputs=lambda: [self.get_artifact('pose_2d', '.npz')],
+                  run=self.run_load_2d,
+                  load=lambda: self.load_2d(self.get_artifact('pose_2d', '.npz'))),
+            Stage('filter_2d',
+                  upstream=['load_2d'],
+                  config=lambda: self.config['filter'],
+                  outputs=lambda: [self.get_artifact('pose_2d_filter', '.npz')],
+                  run=self.run_filter_2d,
+                  load=lambda: self.load_2d(self.get_artifact('pose_2d_filter', '.npz')),
+                  enabled=lambda: self.config['filter'].get('enabled', False)),
+            Stage('triangulate',
+                  upstream=['calibrate', 'load_2d', 'filter_2d'],
+                  config=lambda: {k: v for k, v in self.config['triangulation'].items()
+                                  if k not in FINGERPRINT_IGNORED_KEYS},
+                  outputs=lambda: [self.get_artifact('pose_3d', '_pose3d')],
+                  run=self.run_triangulate,
+                  load=lambda: self.load_3d(self.get_artifact('pose_3d', '_pose3d'))),
+            Stage('filter',
+                  upstream=['triangulate'],
+                  config=lambda: self.config['filter3d'],
+                  outputs=lambda: [self.get_artifact('pose_3d_filter', '_pose3d')],
+                  run=self.run_filter,
+                  load=lambda: self.load_3d(self.get_artifact('pose_3d_filter', '_pose3d')),
+                  enabled=lambda: self.config['filter3d'].get('enabled', False)),
+            Stage('export',
+                  upstream=['triangulate', 'filter'],
+                  config=lambda: {'output_format': self.config['triangulation'].get('output_format', 'csv')},
+                  outputs=lambda: [self.project.get_output_fname()],
+                  run=self.run_export),
+            Stage('plot',
+                  upstream=['triangulate', 'filter'],
+                  outputs=lambda: [self.get_artifact('summaries', '_plot.png')],
+                  run=self.run_plot),
+        ]
+        return {stage.name: stage for stage in stages}
+
+    def get_artifact(self, folder, suffix):
+        # Artifacts go to the folders named in the pipeline section of the config
+        return os.path.join(self.project.project_path, self.config['pipeline'][folder],
+                            self.project.videos_tail + suffix)
+
+    def get_state_fname(self):
+        return os.path.join(self.project.project_path, self.project.videos_tail + '_pipeline.toml')
+
+    def load_state(self):
+        fname = self.get_state_fname()
+        if not os.path.exists(fname):
+            return {'stages': {}}
+        state = toml.load(fname)
+        state.setdefault('stages', {})
+        return state
+
+    def dump_state(self, state):
+        with open(self.get_state_fname(), 'w') as toml_file:
+            toml.dump(state, toml_file)
+
+    def get_signature(self, stage, state):
+        signature = {
+            'enabled': stage.enabled(),
+            'config': stage.config(),
+            'inputs': {path: file_fingerprint(path, content_hash=False) for path in stage.inputs()},
+            'upstream': {name: state['stages'].get(name, {}).get('outputs', {}) for name in stage.upstream},
+        }
+        # Round trip through toml so it compares equal to the stored one
+        return toml.loads(toml.dumps(signature))
+
+    def get_needed_stages(self, targets=None):
+        if targets is None:
+            return list(self.stages)
+
+        needed = set()
+        pending = list(targets)
+        while len(pending) > 0:
+            name = pending.pop()
+            if name not in self.stages:
+                raise ValueError("stage should be one of {} not '{}'".format(list(self.stages), name))
+            if name not in needed:
+                needed.add(name)
+                pending.extend(self.stages[name].upstream)
+
+        return [name for name in self.stages if name in needed]
+
+    def run(self, targets=None, force=()):
+        # targets: stages to bring up to date (with their upstream), all of them by default.
+        # force: stages to run even if their cache is valid
+        state = self.load_state()
+        ran = []
+        for name in self.get_needed_stages(targets):
+            stage = self.stages[name]
+            signature = self.get_signature(stage, state)
+            record = state['stages'].get(name)
+            outputs = stage.outputs() if signature['enabled'] else []
+            if name not in force and record is not None and record['signature'] == signature \
+                    and all(os.path.exists(path) for path in outputs):
+                print('{}: up to date'.format(name))
+                continue
+
+            if not signature['enabled']:
+                print('{}: disabled'.format(name))
+            else:
+                for upstream in stage.upstream:
+                    self.ensure_loaded(upstream)
+                print('\n{}: running ...'.format(name))
+                self.current_record = record
+                stage.run()
+                self.loaded.add(name)
+                ran.append(name)
+
+            state['stages'][name] = {'signature': signature,
+                                     'outputs': {path: path_fingerprint(path) for path in outputs
+                                                 if os.path.exists(path)}}
+            self.dump_state(state)
+
+        return ran
+
+    def ensure_loaded(self, name):
+        if name in self.loaded:
+            return
+        stage = self.stages[name]
+        for upstream in stage.upstream:
+            self.ensure_loaded(upstream)
+        if stage.enabled():
+            stage.load()
+        self.loaded.add(name)
+
+    def run_calibrate(self):
+        calib_file = os.path.join(self.project.calib_path, 'calibration.toml')
+        if self.current_record is not None and os.path.exists(calib_file):
+            # Calibration videos or settings changed since it was made, keep the old one aside
+            print('Calibration inputs changed, moving the old calibration to calibration_old.toml')
+            shutil.move(calib_file, os.path.join(self.project.calib_path, 'calibration_old.toml'))
+            self.project.initialized = False
+        self.project.initialize()
+
+    def run_load_2d(self):
+        # Unfiltered, the filter_2d stage caches the filtered data on its own
+        pose2d = self.project.load_label_data(filter=False)
+        dump_pose2d_npz(self.get_artifact('pose_2d', '.npz'), pose2d)
+
+    def load_2d(self, fname):
+        self.project.pose2d_fnames = load_pose2d_npz(fname)
+
+    def run_filter_2d(self):
+        self.project.filter_label_data(output_fname=self.get_artifact('pose_2d_filter', '.npz'))
+
+    def run_triangulate(self):
+        # The pipeline keeps its own binary copy of the triangulation, whatever the output format
+        output_dir = self.get_artifact('pose_3d', '_pose3d')
+        os.makedirs(os.path.dirname(output_dir), exist_ok=True)
+        self.project.initialize()
+        self.project.output_fname = output_dir
+        pose2d = self.project.pose2d_fnames
+        out = {'points': np.copy(pose2d['points']), 'scores': np.copy(pose2d['scores']),
+               'bodyparts': pose2d['bodyparts']}
+        self.project.process_triangulate(out=out, over_write=True, incremental=False)
+        self.project.data_object.export_data(output_fname=output_dir)
+
+    def load_3d(self, output_dir):
+        self.project.load_data(output_fname=output_dir)
+        self.project.status_triangulate = True
+        self.project.data_object.status_triangulate = True
+
+    def run_filter(self):
+        self.project.data_object.filter_data(output_fname=self.get_artifact('pose_3d_filter', '_pose3d'))
+
+    def run_export(self):
+        output_fname = self.project.get_output_fname()
+        self.project.data_object.export_data(output_fname=output_fname)
+
+    def run_plot(self):
+        fname = self.get_artifact('summaries', '_plot.png')
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        self.project.plot_data(fname=fname)
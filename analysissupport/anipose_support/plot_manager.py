@@ -9,7 +9,8 @@ class PlotManager:
         for key, val in vars(DataManager).items():
             setattr(self, key, val)
 
-    def plot_2D(self):
+    def plot_2D(self, fname=None):
+        # Saved to fname instead of shown when given
 
         if self.status_triangulate == False:
             print('The project is not triangulated. Please run process_triangulate first!')
@@ -25,7 +26,11 @@ class PlotManager:
         plt.xlabel("Time (frames)")
         plt.ylabel("Coordinate (mm)")
         plt.title("x, y, z coordinates of {}".format(self.body_parts[bodyPartIndex]))
-        plt.show()
+        if fname is None:
+            plt.show()
+        else:
+            plt.savefig(fname)
+            plt.close()
 
 
     def connect(ax, points, bps, bp_dict, color):
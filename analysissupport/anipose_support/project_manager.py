@@ -40,6 +40,29 @@ DEFAULT_CONFIG = {
         # board_marker_separation_length = 1 # mm
 
         'board_square_side_length': 25, #  If charuco or checkerboard, square side length mm
+
+        'registry': '', # path of a calibration registry shared by sessions, reused before recalibrating
+        'rig': '', # name of the camera rig. When set, a registered calibration of the same rig, cameras, board and day is reused, otherwise only one made from the same videos
+        'detection_cache': False, # detect the charuco board once per video and share it between calibration and labeling
+        'detection_stride': 1, # only detect the board on every Nth frame of the calibration videos
+        'max_frames': 0, # if > 0, calibrate on at most this many frames picked for board coverage and pose diversity
+        'label_parallel': False, # label the calibration videos using a process pool
+        'label_workers': 0, # number of labeling processes, 0 to use all cores
+        'label_batch_size': 32, # frames sent to a labeling process at a time
+        'label_stride': 1, # label every Nth frame of the calibration videos
+        'label_window': [], # [start, end] in seconds to only label part of the videos
+        'label_scale': 1.0, # resize factor of the labeled frames, e.g. 0.5 for a preview
+        'label_contact_sheet': 0, # if > 0, save this many labeled frames as one image instead of a video
+        'label_sheet_scale': 0.25, # resize factor of the contact sheet tiles
+    },
+    'labeling': {
+        'scheme': [],
+        'scorer': '', # only use DeepLabCut outputs whose scorer contains this, e.g. 'resnet50_treadmill'
+        'filtered': False, # use the DeepLabCut outputs ending in _filtered
+        'pose_extension': '.h5',
+        'fast_reader': True, # read the DeepLabCut .h5 files directly instead of through pandas
+        'read_executor': '', # 'process' to read the cameras in parallel, worth it on network drives
+        'read_workers': 0, # 0 for one worker per camera
     },
     'manual_verification': {
         'manually_verify': False
@@ -56,6 +79,10 @@ DEFAULT_CONFIG = {
         'constraints': [],
         'constraints_weak': [],
         'cam_regex': "cam([1-9])",
+        'engine': 'aniposelib', # 'aniposelib' or 'dlt' for the batched linear triangulation
+        'output_format': 'csv', # 'csv' or 'npy' for a folder of binary arrays
+        'chunk_size': 0, # frames per triangulation chunk, 0 to triangulate the whole session at once
+        'incremental': False, # only re-triangulate when the 2D files, calibration or these settings changed
     },
     'pipeline': {
         'videos_raw': 'videos-raw',
@@ -87,7 +114,12 @@ DEFAULT_CONFIG = {
         'multiprocessing': False
     },
     'filter3d': {
-        'enabled': False
+        'enabled': False,
+        'reproj_error_threshold': 10, # drop 3D points with a larger mean reprojection error (pixels)
+        'max_gap': 10, # interpolate missing runs of at most this many frames
+        'smooth': 'savgol', # 'savgol' or 'none'
+        'window': 11, # Savitzky-Golay window in frames
+        'order': 3, # Savitzky-Golay polynomial order
     }
 }
 
@@ -101,7 +133,8 @@ class ProjectManager:
                  cam_names=['cam1', 'cam2'],
                  video_type='.avi',
                  model_folder=None,
-                 config=None) -> None:
+                 config=None,
+                 lazy=False) -> None:
 
         self.project_path = project_path
         self.calib_path = calib_path
@@ -114,10 +147,51 @@ class ProjectManager:
         self.videos_type = video_type
         self.model_folder = model_folder
         self.config = self.load_config(config)
-        self.dump_config(self.config)
+        self.status_triangulate = False
+
+        # Lazy projects only dump the config and load (or run) the calibration on first use
+        self.initialized = False
+        if not lazy:
+            self.initialize()
 
+    def initialize(self):
+        if getattr(self, 'initialized', True):
+            return self
+
+        self.dump_config(self.config)
         self.check_calibration()
-        self.status_triangulate = False
+        self.initialized = True
+        return self
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, e.g. the cgroup of a project that was not used yet
+        if name in ['cgroup', 'calibration_object'] and not self.__dict__.get('initialized', True):
+            self.initialize()
+            return self.__dict__[name]
+        # e.g. a project triangulated by a worker of PathManager.batch_triangulate_parallel
+        if name == 'data_object' and self.__dict__.get('status_triangulate') \
+                and os.path.exists(self.__dict__.get('output_fname', '')):
+            from analysissupport.anipose_support.data_manager import DataManager
+
+            data_object = DataManager(self)
+            data_object.load_data()
+            self.data_object = data_object
+            return data_object
+        raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+
+    def __getstate__(self):
+        # The calibration board holds OpenCV objects that cannot be pickled, so
+        # workers get the project without it and reload the CameraGroup from disk
+        state = self.__dict__.copy()
+        for key in ['calibration_object', 'cgroup', 'label_object', 'pipeline_object']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        calib_file = os.path.join(self.calib_path, str("calibration.toml"))
+        if os.path.exists(calib_file):
+            self.cgroup = CameraGroup.load(calib_file)
 
     def check_calibration(self, config=None):
         # Handle by calibration_manager.py
@@ -129,29 +203,47 @@ class ProjectManager:
     def export_calibration(self, config=None):
         return self.calibration_object
 
-    def process_triangulate(self, config=None, out=None, score_threshold=0.5, over_write=True):
+    def process_triangulate(self, config=None, out=None, score_threshold=0.5, over_write=True, chunk_size=None,
+                            incremental=None):
         # Handle by data_manager.py
         from analysissupport.anipose_support.data_manager import DataManager
 
+        self.initialize()
         self.data_object = DataManager(self)
-        self.data_object.process_triangulate(config=config, out=out, score_threshold=score_threshold, over_write=over_write)
+        self.data_object.process_triangulate(config=config, out=out, score_threshold=score_threshold,
+                                             over_write=over_write, chunk_size=chunk_size,
+                                             incremental=incremental)
 
-    def plot_data(self):
+    def plot_data(self, fname=None):
         # Handle by plot_manager.py
         from analysissupport.anipose_support.plot_manager import PlotManager
         try:
             plot_object = PlotManager(self, self.data_object)
-            plot_object.plot_2D()
+            plot_object.plot_2D(fname=fname)
         except AttributeError:
             print('Data is not loaded or not available. Please try again!')
             pass
 
+    def filter_data(self, config=None, output_fname=None):
+        # Handle by data_manager.py, the filtered data goes to the pose_3d_filter folder
+        try:
+            self.data_object.filter_data(config=config, output_fname=output_fname)
+        except AttributeError:
+            print('Data is not loaded or not available. Please try again!')
+
+    def run_pipeline(self, targets=None, force=()):
+        # Handle by pipeline_manager.py
+        from analysissupport.anipose_support.pipeline_manager import PipelineManager
+        self.pipeline_object = PipelineManager(self)
+        return self.pipeline_object.run(targets=targets, force=force)
+
     def export_data(self, output_fname=None, config=None):
         try:
             self.data_object.export_data(output_fname=output_fname, config=config)
         except AttributeError:
             from analysissupport.anipose_support.data_manager import DataManager
 
+            self.initialize()
             self.data_object = DataManager(self)
             self.data_object.process_triangulate()
             self.data_object.export_data(output_fname=output_fname, config=config)
@@ -165,18 +257,71 @@ class ProjectManager:
             self.data_object = DataManager(self)
             self.data_object.load_data(output_fname=output_fname, config=config)
 
-    def load_label_data(self):
+    def load_data_lazy(self, output_fname=None):
+        try:
+            return self.data_object.load_data_lazy(output_fname=output_fname)
+        except AttributeError:
+            from analysissupport.anipose_support.data_manager import DataManager
+
+            self.data_object = DataManager(self)
+            return self.data_object.load_data_lazy(output_fname=output_fname)
+
+    def load_label_data(self, filter=None):
+        # filter: run the 2D filter on the loaded data, config['filter']['enabled'] by default
         from analysissupport.anipose_support.label_manager import LabelManager
+        self.initialize()
         self.label_object = LabelManager(self)
         self.pose2d_fnames = self.label_object.load_pose2D()
+        self.pose2d_files = self.label_object.videos_result
+
+        if filter is None:
+            filter = self.config['filter'].get('enabled', False)
+        if filter:
+            self.filter_label_data()
+
+        return self.pose2d_fnames
 
+    def filter_label_data(self, output_fname=None):
+        # Handle by label_manager.py
+        from analysissupport.anipose_support.label_manager import LabelManager
+        if getattr(self, 'label_object', None) is None:
+            self.initialize()
+            self.label_object = LabelManager(self)
+        self.pose2d_fnames = self.label_object.filter_pose2D(self.pose2d_fnames, output_fname=output_fname)
         return self.pose2d_fnames
 
-    def get_output_fname(self):
-        self.output_fname = os.path.join(self.project_path, self.videos_tail + '.csv')
+    def get_pose2d_files(self):
+        # Only resolve which 2D files belong to this project, without loading them
+        if not hasattr(self, 'pose2d_files'):
+            from analysissupport.anipose_support.label_manager import LabelManager
+            self.initialize()
+            self.label_object = LabelManager(self)
+            self.pose2d_files = self.label_object.create_pose_dict()
+
+        return self.pose2d_files
+
+    def get_output_fname(self, config=None):
+        if config is None:
+            config = self.config
+
+        if config['triangulation'].get('output_format', 'csv') == 'npy':
+            # Folder of .npy arrays and metadata, see DataManager.export_binary
+            self.output_fname = os.path.join(self.project_path, self.videos_tail + '_pose3d')
+        else:
+            self.output_fname = os.path.join(self.project_path, self.videos_tail + '.csv')
         
         return self.output_fname
 
+    def get_filtered_output_fname(self, config=None):
+        # Same format as get_output_fname, in the pose_3d_filter folder
+        if config is None:
+            config = self.config
+
+        folder = os.path.join(self.project_path, config['pipeline']['pose_3d_filter'])
+        if config['triangulation'].get('output_format', 'csv') == 'npy':
+            return os.path.join(folder, self.videos_tail + '_pose3d')
+        return os.path.join(folder, self.videos_tail + '.csv')
+
     def dump_config(self, config):
         fname = 'config.toml'
         # toml_string = toml.dumps(config)
@@ -0,0 +1,83 @@
+import numpy as np
+
+TRIANGULATION_ENGINES = ['aniposelib', 'dlt']
+
+
+def undistort_points_batch(cgroup, points):
+    # points: (n_cams, n_points, 2) in pixels -> normalized image coordinates
+    new_points = np.empty(points.shape)
+    for cnum, cam in enumerate(cgroup.cameras):
+        sub = np.copy(points[cnum]).reshape(-1, 1, 2)
+        new_points[cnum] = cam.undistort_points(sub).reshape(-1, 2)
+    return new_points
+
+
+def triangulate_dlt(cgroup, points, undistort=True, batch_size=100000):
+    """
+    Linear (DLT) triangulation of every point at once.
+
+    Equivalent to CameraGroup.triangulate, but instead of solving one SVD per point in
+    a Python loop, the DLT systems are stacked and solved with a single batched SVD.
+    Cameras where a point is missing get zero rows, which leaves the solution the same
+    as solving with the remaining cameras only. Points seen by fewer than 2 cameras are NaN.
+
+    points: (n_cams, n_points, 2) array of 2D points, returns (n_points, 3)
+    """
+    if undistort:
+        points = undistort_points_batch(cgroup, points)
+
+    n_cams, n_points, _ = points.shape
+    cam_mats = np.array([cam.get_extrinsics_mat() for cam in cgroup.cameras])[:, :3]
+
+    out = np.full((n_points, 3), np.nan)
+    for start in range(0, n_points, batch_size):
+        end = min(start + batch_size, n_points)
+        sub = points[:, start:end]
+        good = ~np.isnan(sub[:, :, 0])
+        enough = np.sum(good, axis=0) >= 2
+        if not np.any(enough):
+            continue
+
+        sub = np.nan_to_num(sub[:, enough])
+        good = good[:, enough]
+
+        # rows of the DLT system for each camera: x * P[2] - P[0] and y * P[2] - P[1]
+        rows_x = sub[:, :, 0, None] * cam_mats[:, None, 2] - cam_mats[:, None, 0]
+        rows_y = sub[:, :, 1, None] * cam_mats[:, None, 2] - cam_mats[:, None, 1]
+        A = np.stack([rows_x, rows_y], axis=2)
+        A[~good] = 0
+        A = A.transpose(1, 0, 2, 3).reshape(-1, n_cams * 2, 4)
+
+        _, _, vh = np.linalg.svd(A)
+        p3d = vh[:, -1]
+        out[start:end][enough] = p3d[:, :3] / p3d[:, 3, None]
+
+    return out
+
+
+def reprojection_error_batch(cgroup, p3ds, p2ds, mean=False):
+    """
+    Reprojection error of (n_points, 3) points against (n_cams, n_points, 2) observations.
+
+    Each camera projects all points with one call. Returns (n_cams, n_points, 2) errors,
+    or the (n_points,) mean error norm over the cameras that saw the point if mean=True,
+    matching CameraGroup.reprojection_error.
+    """
+    n_cams, n_points, _ = p2ds.shape
+    errors = np.full((n_cams, n_points, 2), np.nan)
+    valid = ~np.isnan(p3ds[:, 0])
+
+    if np.any(valid):
+        for cnum, cam in enumerate(cgroup.cameras):
+            projected = cam.project(p3ds[valid]).reshape(-1, 2)
+            errors[cnum, valid] = p2ds[cnum, valid] - projected
+
+    if mean:
+        errors_norm = np.linalg.norm(errors, axis=2)
+        good = ~np.isnan(errors_norm)
+        errors_norm[~good] = 0
+        denom = np.sum(good, axis=0).astype('float64')
+        denom[denom < 1.5] = np.nan
+        errors = np.sum(errors_norm, axis=0) / denom
+
+    return errors
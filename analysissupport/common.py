@@ -1,5 +1,16 @@
 import os
+import hashlib
+import multiprocessing
 from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+EXECUTORS = {
+    'process': ProcessPoolExecutor,
+    'thread': ThreadPoolExecutor,
+    # Workers started fresh instead of forked, forking next to OpenCV or BLAS threads can hang
+    'spawn': partial(ProcessPoolExecutor, mp_context=multiprocessing.get_context('spawn')),
+}
 
 
 def get_folders(path):
@@ -7,57 +18,125 @@ def get_folders(path):
     return sorted(folders)
 
 
-def process_all(config, process_session, **args):
+def file_hash(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_head_hash(path, n_bytes=1 << 20):
+    # Hash of the first n_bytes only. Cheap enough for videos and still tells copies
+    # of the same recording apart from different ones
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read(n_bytes)).hexdigest()
+
+
+def file_fingerprint(path, previous=None, content_hash=True):
+    # Size, mtime and content hash of a file. The hash is reused from the previous
+    # fingerprint when size and mtime did not change, so it is only computed once.
+    # Large files such as videos can skip the hash with content_hash=False
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if not content_hash:
+        return fingerprint
+    if previous is not None and 'sha1' in previous and not file_changed(path, previous, check_hash=False):
+        fingerprint['sha1'] = previous['sha1']
+    else:
+        fingerprint['sha1'] = file_hash(path)
+    return fingerprint
+
+
+def file_changed(path, previous, check_hash=True):
+    # Same size and mtime means unchanged. If only the mtime moved (copied or touched
+    # files) the content hash decides, and when it matches previous gets the new mtime so
+    # the caller can store it and skip hashing next time
+    if previous is None or not os.path.exists(path):
+        return True
+    stat = os.stat(path)
+    if stat.st_size != previous['size']:
+        return True
+    if stat.st_mtime == previous['mtime']:
+        return False
+    if not check_hash or 'sha1' not in previous:
+        return True
+    if file_hash(path) != previous['sha1']:
+        return True
+    previous['mtime'] = stat.st_mtime
+    return False
+
+
+def match_cam_name(fname, cam_names):
+    # Camera whose name starts the file name, longest names first so cam10_x.avi is not
+    # taken for cam1. None when no camera matches
+    for cam_name in sorted(cam_names, key=len, reverse=True):
+        if fname.startswith(cam_name):
+            return cam_name
+    return None
+
+
+def find_sessions(config):
+    """Walk the nested folders and return the (path, past_folders) of every
+    session, in the order process_all and process_all_parallel visit them."""
     pipeline_prefix = config['path']
     nesting = config['nesting']
 
-    output = dict()
-
     if nesting == 0:
-        output[()] = process_session(config, pipeline_prefix, **args)
-        return output
-
-    folders = get_folders(pipeline_prefix)
-    level = 1
+        return [(pipeline_prefix, ())]
 
+    sessions = []
     q = deque()
-
-    next_folders = [(os.path.join(pipeline_prefix, folder),
-                     (folder,),
-                     level)
-                    for folder in folders]
-    q.extend(next_folders)
+    q.extend([(os.path.join(pipeline_prefix, folder), (folder,), 1)
+              for folder in get_folders(pipeline_prefix)])
 
     while len(q) != 0:
         path, past_folders, level = q.pop()
 
-        if nesting < 0:
-            output[past_folders] = process_session(config, path, **args)
-
-            folders = get_folders(path)
-            next_folders = [(os.path.join(path, folder),
-                             past_folders + (folder,),
-                             level + 1)
-                            for folder in folders]
-            q.extend(next_folders)
-        else:
-            if level == nesting:
-                output[past_folders] = process_session(config, path, **args)
-            elif level > nesting:
-                continue
-            elif level < nesting:
-                folders = get_folders(path)
-                next_folders = [(os.path.join(path, folder),
-                                 past_folders + (folder,),
-                                 level + 1)
-                                for folder in folders]
-                q.extend(next_folders)
+        if nesting < 0 or level == nesting:
+            sessions.append((path, past_folders))
+
+        if nesting < 0 or level < nesting:
+            q.extend([(os.path.join(path, folder),
+                       past_folders + (folder,),
+                       level + 1)
+                      for folder in get_folders(path)])
+
+    return sessions
+
+
+def process_all_parallel(config, process_session, executor='process', max_workers=None, **args):
+    if executor not in EXECUTORS:
+        raise ValueError("executor should be one of {} not '{}'".format(
+            list(EXECUTORS.keys()), executor))
+
+    sessions = find_sessions(config)
+
+    output = dict()
+    with EXECUTORS[executor](max_workers=max_workers) as pool:
+        futures = [(past_folders, pool.submit(process_session, config, path, **args))
+                   for path, past_folders in sessions]
+        for past_folders, future in futures:
+            output[past_folders] = future.result()
+
+    return output
+
+
+def process_all(config, process_session, executor=None, max_workers=None, **args):
+    if executor is not None:
+        return process_all_parallel(config, process_session,
+                                    executor=executor, max_workers=max_workers, **args)
+
+    output = dict()
+    for path, past_folders in find_sessions(config):
+        output[past_folders] = process_session(config, path, **args)
 
     return output
 
 
 def make_process_fun(process_session, **args):
-    def fun(config):
-        return process_all(config, process_session, **args)
+    def fun(config, executor=None, max_workers=None):
+        return process_all(config, process_session,
+                           executor=executor, max_workers=max_workers, **args)
 
     return fun
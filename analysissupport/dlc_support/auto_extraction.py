@@ -90,13 +90,11 @@ class AutoFrameExtraction:
             frames2pick = frames2pick[0::100]
             
             # Extracting and saving the frames
-            cap = VideoReader(video)
+            cap = VideoReader(video, use_cache=True)
             nframes = len(cap)
             indexlength = int(np.ceil(np.log10(nframes)))
             is_valid = []
-            for index in frames2pick:
-                cap.set_to_frame(index)  # extract a particular frame
-                frame = cap.read_frame()
+            for index, frame in zip(frames2pick, cap.read_frames(frames2pick)):
                 if frame is not None:
                     image = img_as_ubyte(frame)
                     img_name = (
@@ -127,7 +125,7 @@ class AutoFrameExtraction:
     def addFrameToLabeledData(self):
         for video in self.videoUnprocessList:
             videoName = Path(video).stem
-            cap = VideoReader(video)
+            cap = VideoReader(video, use_cache=True)
             nframes = len(cap)
             indexlength = int(np.ceil(np.log10(nframes)))
 
@@ -192,9 +190,7 @@ class AutoFrameExtraction:
 
             # Extract and save the frames from the frame index list
             is_valid = []
-            for index in frames2pick:
-                cap.set_to_frame(index)  # extract a particular frame
-                frame = cap.read_frame()
+            for index, frame in zip(frames2pick, cap.read_frames(frames2pick)):
                 if frame is not None:
                     image = img_as_ubyte(frame)
                     img_name = (
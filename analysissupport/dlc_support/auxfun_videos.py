@@ -8,25 +8,115 @@ Please see AUTHORS for contributors.
 https://github.com/AlexEMG/DeepLabCut/blob/master/AUTHORS
 Licensed under GNU Lesser General Public License v3.0
 """
+import atexit
 import cv2
+import collections
 import datetime
+import json
 import numpy as np
 import os
+import queue
+import shutil
 import subprocess
+import threading
+import time
 import warnings
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+OUTPUT_FORMATS = ["rgb", "bgr", "gray"]
+
+# Probed metadata of the videos of a folder, keyed by file name and valid while the size
+# and mtime of the video match. Kept in memory until the cache file changes
+METADATA_CACHE_NAME = "video_metadata.json"
+_METADATA_CACHE = dict()
+
+
+def load_metadata_cache(folder):
+    fname = os.path.join(folder, METADATA_CACHE_NAME)
+    try:
+        mtime = os.stat(fname).st_mtime_ns
+    except OSError:
+        return dict()
+
+    cached = _METADATA_CACHE.get(folder)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    try:
+        with open(fname) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        entries = dict()
+    _METADATA_CACHE[folder] = (mtime, entries)
+    return entries
+
+
+def get_cached_metadata(video_path):
+    folder, name = os.path.split(os.path.abspath(video_path))
+    entry = load_metadata_cache(folder).get(name)
+    if entry is None:
+        return None
+    stat = os.stat(video_path)
+    if entry.get("size") != stat.st_size or entry.get("mtime") != stat.st_mtime:
+        return None
+    return entry
+
+
+def update_metadata_cache(video_path, values):
+    # Best effort: a read-only folder only means the video gets probed again next time
+    folder, name = os.path.split(os.path.abspath(video_path))
+    entries = dict(load_metadata_cache(folder))
+    stat = os.stat(video_path)
+    entry = get_cached_metadata(video_path)
+    entry = dict(entry) if entry is not None else {"size": stat.st_size, "mtime": stat.st_mtime}
+    entry.update(values)
+    entries[name] = entry
+
+    fname = os.path.join(folder, METADATA_CACHE_NAME)
+    # One temporary file per process, other processes may be probing the same folder
+    tmp_fname = "{}.{}.tmp".format(fname, os.getpid())
+    try:
+        with open(tmp_fname, "w") as f:
+            json.dump(entries, f, indent=1)
+        os.replace(tmp_fname, fname)
+        _METADATA_CACHE[folder] = (os.stat(fname).st_mtime_ns, entries)
+    except OSError:
+        try:
+            os.remove(tmp_fname)
+        except OSError:
+            pass
 
 
 class VideoReader:
-    def __init__(self, video_path):
+    # output: "rgb" (contiguous), "bgr" (as decoded) or "gray".
+    # reuse_buffer: decode and convert into the same arrays every frame, so a returned
+    # frame is only valid until the next read. Meant for loops that do not keep frames.
+    # use_cache: take the metadata from the folder's metadata cache when it is up to date,
+    # the capture is then only opened once frames are read. Off by default since probing
+    # then writes the cache file into the video's folder
+    def __init__(self, video_path, output="rgb", reuse_buffer=False, use_cache=False):
         if not os.path.isfile(video_path):
             raise ValueError(f'Video path "{video_path}" does not point to a file.')
+        if output not in OUTPUT_FORMATS:
+            raise ValueError(f"output should be one of {OUTPUT_FORMATS} not '{output}'")
         self.video_path = video_path
-        self.video = cv2.VideoCapture(video_path)
-        if not self.video.isOpened():
-            raise IOError("Video could not be opened; it may be corrupted.")
-        self.parse_metadata()
+        self.use_cache = use_cache
+        self._video = None
         self._bbox = 0, 1, 0, 1
         self._n_frames_robust = None
+        cached = get_cached_metadata(video_path) if use_cache else None
+        if cached is not None:
+            self.load_metadata(cached)
+        else:
+            self.parse_metadata()
+            if use_cache:
+                update_metadata_cache(video_path, self.probed_metadata())
+        self.output = output
+        self.reuse_buffer = reuse_buffer
+        self._raw = None
+        self._converted = None
 
     def __repr__(self):
         string = "Video (duration={:0.2f}, fps={}, dimensions={}x{})"
@@ -35,6 +125,22 @@ class VideoReader:
     def __len__(self):
         return self._n_frames
 
+    @property
+    def video(self):
+        if self._video is None:
+            self._video = cv2.VideoCapture(self.video_path)
+            if not self._video.isOpened():
+                raise IOError("Video could not be opened; it may be corrupted.")
+        return self._video
+
+    def __iter__(self):
+        # Remaining frames from the current position, with the default read_frame options
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
+
     def check_integrity(self):
         dest = os.path.join(self.directory, f"{self.name}.log")
         command = f"ffmpeg -v error -i {self.video_path} -f null - 2>{dest}"
@@ -82,10 +188,15 @@ class VideoReader:
                 command, shell=True, stderr=subprocess.STDOUT
             )
             self._n_frames_robust = int(output)
+            if self.use_cache:
+                update_metadata_cache(self.video_path, {"n_frames_robust": self._n_frames_robust})
         return self._n_frames_robust
 
     def calc_duration(self, robust=False):
         if robust:
+            cached = get_cached_metadata(self.video_path) if self.use_cache else None
+            if cached is not None and "duration_robust" in cached:
+                return cached["duration_robust"]
             command = (
                 f'ffprobe -i "{self.video_path}" -show_entries '
                 f'format=duration -v quiet -of csv="p=0"'
@@ -93,6 +204,8 @@ class VideoReader:
             output = subprocess.check_output(
                 command, shell=True, stderr=subprocess.STDOUT
             )
+            if self.use_cache:
+                update_metadata_cache(self.video_path, {"duration_robust": float(output)})
             return float(output)
         return len(self) / self.fps
 
@@ -111,11 +224,22 @@ class VideoReader:
     def reset(self):
         self.set_to_frame(0)
 
-    def read_frame(self, shrink=1, crop=False):
-        success, frame = self.video.read()
+    def decode(self):
+        # Next decoded BGR frame, or None at the end of the video
+        success, frame = self.video.read(self._raw if self.reuse_buffer else None)
         if not success:
             return
-        frame = frame[..., ::-1]  # return RGB rather than BGR!
+        if self.reuse_buffer:
+            self._raw = frame
+        return frame
+
+    def read_frame(self, shrink=1, crop=False):
+        frame = self.decode()
+        if frame is None:
+            return
+        return self.process_frame(frame, shrink=shrink, crop=crop)
+
+    def process_frame(self, frame, shrink=1, crop=False):
         if crop:
             x1, x2, y1, y2 = self.get_bbox(relative=False)
             frame = frame[y1:y2, x1:x2]
@@ -128,7 +252,78 @@ class VideoReader:
                 fy=0,
                 interpolation=cv2.INTER_AREA,
             )
-        return frame
+        if self.output == "bgr":
+            return frame
+
+        code = cv2.COLOR_BGR2RGB if self.output == "rgb" else cv2.COLOR_BGR2GRAY
+        if not self.reuse_buffer:
+            return cv2.cvtColor(frame, code)
+        shape = frame.shape if self.output == "rgb" else frame.shape[:2]
+        if self._converted is None or self._converted.shape != shape:
+            self._converted = np.empty(shape, dtype=frame.dtype)
+        return cv2.cvtColor(frame, code, dst=self._converted)
+
+    def read_frames(self, indices, shrink=1, crop=False, max_forward=32):
+        """
+        Frames at the given indices, yielded in the order of indices (None for unreadable ones).
+
+        The indices are visited in increasing order. For each gap the reader either decodes
+        forward with grab() or seeks, whichever is cheaper: a seek decodes from the previous
+        keyframe, so its cost is measured on the fly and compared to the measured cost of
+        grabbing the frames of the gap. Before any measurement, gaps up to max_forward frames
+        are decoded forward.
+        """
+        indices = [int(ind) for ind in indices]
+        wanted = sorted(set(indices))
+        remaining = collections.Counter(indices)
+        frames = dict()
+        pending = 0
+
+        pos = None
+        grab_time = seek_time = None
+        for ind in wanted:
+            if ind < 0 or ind >= len(self):
+                frames[ind] = None
+            else:
+                gap = ind - pos if pos is not None else -1
+                if gap < 0 or (grab_time is None and gap > max_forward) \
+                        or (seek_time is not None and grab_time is not None and gap * grab_time > seek_time):
+                    start = time.perf_counter()
+                    self.video.set(cv2.CAP_PROP_POS_FRAMES, ind)
+                    frame = self.decode()
+                    success = frame is not None
+                    elapsed = time.perf_counter() - start
+                    seek_time = elapsed if seek_time is None else 0.8 * seek_time + 0.2 * elapsed
+                else:
+                    start = time.perf_counter()
+                    success = all(self.video.grab() for _ in range(gap))
+                    if gap > 0:
+                        elapsed = (time.perf_counter() - start) / gap
+                        grab_time = elapsed if grab_time is None else 0.8 * grab_time + 0.2 * elapsed
+                    if success:
+                        frame = self.decode()
+                        success = frame is not None
+
+                if success:
+                    frame = self.process_frame(frame, shrink=shrink, crop=crop)
+                    if self.reuse_buffer and (indices[pending] != ind or remaining[ind] > 1):
+                        # Kept for later, so it must not be overwritten by the next read
+                        frame = frame.copy()
+                    frames[ind] = frame
+                    pos = ind + 1
+                else:
+                    frames[ind] = None
+                    pos = None
+
+            # Hand out the frames as soon as the caller's order allows, and drop them after their last use
+            while pending < len(indices) and indices[pending] in frames:
+                current = indices[pending]
+                pending += 1
+                frame = frames[current]
+                remaining[current] -= 1
+                if remaining[current] == 0:
+                    del frames[current]
+                yield frame
 
     def get_bbox(self, relative=False):
         x1, x2, y1, y2 = self._bbox
@@ -173,5 +368,242 @@ class VideoReader:
         self._height = int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT))
         self._fps = round(self.video.get(cv2.CAP_PROP_FPS), 2)
 
+    def probed_metadata(self):
+        return dict(n_frames=self._n_frames, width=self._width, height=self._height, fps=self._fps)
+
+    def load_metadata(self, metadata):
+        self._n_frames = metadata["n_frames"]
+        self._width = metadata["width"]
+        self._height = metadata["height"]
+        self._fps = metadata["fps"]
+        self._n_frames_robust = metadata.get("n_frames_robust")
+
     def close(self):
-        self.video.release()
+        # A later read opens the capture again
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+
+
+
+# Decoding threads still running at exit are stopped before the interpreter tears down
+_PREFETCH_READERS = weakref.WeakSet()
+
+
+@atexit.register
+def _stop_prefetch_readers():
+    for reader in list(_PREFETCH_READERS):
+        reader.stop()
+
+
+class PrefetchVideoReader(VideoReader):
+    """
+    VideoReader decoding ahead in a background thread.
+
+    Up to `depth` decoded frames wait in a queue, so a sequential consumer overlaps its own
+    work with the decoding (OpenCV releases the GIL while decoding). read_frame, iteration,
+    set_to_frame and close behave as in VideoReader; seeking restarts the decoding thread.
+    """
+    def __init__(self, video_path, depth=16, output="rgb", reuse_buffer=False, use_cache=False):
+        super().__init__(video_path, output=output, reuse_buffer=reuse_buffer, use_cache=use_cache)
+        self.depth = depth
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decode(self):
+        # Always ends the queue, with None at the end of the video or the error that stopped
+        # the decoding, which read_frame raises on the caller's thread
+        end = None
+        try:
+            while not self._stop.is_set():
+                success, frame = self.video.read()
+                if not success or not self._put(frame):
+                    break
+        except Exception as e:
+            end = e
+        finally:
+            self._put(end)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._thread = threading.Thread(target=self._decode, daemon=True)
+        self._thread.start()
+        _PREFETCH_READERS.add(self)
+
+    def stop(self):
+        if getattr(self, "_thread", None) is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._queue = None
+
+    def read_frame(self, shrink=1, crop=False):
+        # Queued frames are decoded into their own arrays, only the conversion buffer is reused
+        self.start()
+        frame = self._queue.get()
+        if frame is None or isinstance(frame, Exception):
+            # Keep answering the same at the end of the video
+            self._queue.put(frame)
+            if frame is None:
+                return
+            raise frame
+        return self.process_frame(frame, shrink=shrink, crop=crop)
+
+    def set_to_frame(self, ind):
+        # The decoding thread owns the capture, stop it before seeking
+        self.stop()
+        super().set_to_frame(ind)
+
+    def read_frames(self, indices, shrink=1, crop=False, max_forward=32):
+        # Random access reads the capture directly, and leaves the position undefined
+        self.stop()
+        for frame in super().read_frames(indices, shrink=shrink, crop=crop, max_forward=max_forward):
+            yield frame
+
+    def close(self):
+        self.stop()
+        super().close()
+
+    def __del__(self):
+        self.stop()
+
+
+# Integrity results of the videos of a folder, see check_folder_integrity
+INTEGRITY_STATUS_NAME = "integrity-status.json"
+
+
+def resolve_engine(engine):
+    # "auto" is ffmpeg when it is installed, opencv otherwise
+    if engine == "auto":
+        engine = "ffmpeg" if shutil.which("ffmpeg") is not None else "opencv"
+    if engine not in ["ffmpeg", "opencv"]:
+        raise ValueError(f"engine should be one of ['auto', 'ffmpeg', 'opencv'] not '{engine}'")
+    return engine
+
+
+def check_video(video_path, engine="auto"):
+    """
+    Decode a video once and report the errors found.
+
+    engine "ffmpeg" runs ffmpeg -v error into a null output, "opencv" grabs every frame and
+    compares the count with the header, "auto" uses ffmpeg when it is installed.
+    Returns a dict with ok, errors (list of messages), n_frames (None with ffmpeg) and engine.
+    """
+    engine = resolve_engine(engine)
+
+    if engine == "ffmpeg":
+        result = subprocess.run(
+            ["ffmpeg", "-v", "error", "-i", video_path, "-f", "null", "-"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        errors = result.stderr.decode(errors="replace").splitlines()
+        if result.returncode != 0 and len(errors) == 0:
+            errors = [f"ffmpeg exited with code {result.returncode}"]
+        return dict(ok=len(errors) == 0, errors=errors, n_frames=None, engine=engine)
+
+    try:
+        reader = VideoReader(video_path, use_cache=False)
+        video = reader.video
+    except (IOError, ValueError) as e:
+        return dict(ok=False, errors=[str(e)], n_frames=0, engine=engine)
+
+    # grab() decodes without converting the frames
+    n_frames = 0
+    while video.grab():
+        n_frames += 1
+    reader.close()
+
+    errors = []
+    if n_frames < len(reader):
+        errors.append(f"Only {n_frames} of the {len(reader)} frames in the header could be decoded")
+    return dict(ok=len(errors) == 0, errors=errors, n_frames=n_frames, engine=engine)
+
+
+def load_integrity_status(folder):
+    fname = os.path.join(folder, INTEGRITY_STATUS_NAME)
+    if not os.path.exists(fname):
+        return dict()
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def dump_integrity_status(folder, status):
+    fname = os.path.join(folder, INTEGRITY_STATUS_NAME)
+    tmp_fname = "{}.{}.tmp".format(fname, os.getpid())
+    with open(tmp_fname, "w") as f:
+        json.dump(status, f, indent=1)
+    os.replace(tmp_fname, fname)
+
+
+def list_videos(folder, videotype=".avi"):
+    # Same selection as ProcessVideoList, without changing the working directory
+    with os.scandir(folder) as entries:
+        return sorted(
+            entry.path
+            for entry in entries
+            if entry.is_file()
+            and entry.name.endswith(videotype)
+            and "_labeled." not in entry.name
+            and "_full." not in entry.name
+        )
+
+
+def check_folder_integrity(folders, videotype=".avi", max_workers=4, engine="auto", force=False, verbose=True):
+    """
+    Check every video of the folders with a pool of max_workers decoders.
+
+    Results are kept per folder in integrity-status.json along with the size and mtime of
+    each video and the check settings, and videos that did not change since their last check
+    with the same settings are skipped unless force. The status file is updated as checks
+    finish, so an interrupted scan resumes.
+    Returns {video path: result} for all the videos, checked now or before.
+    """
+    # "auto" is resolved first, a result of the other engine is not reused
+    engine = resolve_engine(engine)
+    settings = {"engine": engine}
+    statuses = {folder: load_integrity_status(folder) for folder in folders}
+    results = dict()
+    todo = []
+    for folder in folders:
+        for video in list_videos(folder, videotype):
+            stat = os.stat(video)
+            entry = statuses[folder].get(os.path.basename(video))
+            if not force and entry is not None and entry["size"] == stat.st_size \
+                    and entry["mtime"] == stat.st_mtime and entry.get("settings") == settings:
+                results[video] = entry
+            else:
+                todo.append((folder, video, stat))
+
+    if verbose:
+        print(f"{len(todo)} videos to check, {len(results)} unchanged since their last check")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(check_video, video, engine): (folder, video, stat)
+                   for folder, video, stat in todo}
+        for future in as_completed(futures):
+            folder, video, stat = futures[future]
+            result = dict(future.result(), size=stat.st_size, mtime=stat.st_mtime, settings=settings)
+            results[video] = result
+            statuses[folder][os.path.basename(video)] = result
+            dump_integrity_status(folder, statuses[folder])
+            if verbose:
+                print(f"{'OK' if result['ok'] else 'FAILED':<7}{video}")
+
+    return results
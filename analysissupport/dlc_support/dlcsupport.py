@@ -205,6 +205,40 @@ def train_network(config):
     import tensorflow as tf
     deeplabcut.train_network(config=config['config-path'], shuffle=1, displayiters=10, saveiters=500)
 
+@cli.command()
+@click.option("--video_folder",
+              prompt=True,
+              required=True,
+              default="[]",
+              help="List of folders containing the videos")
+@click.option("--videotype",
+              default=".avi",
+              help="Set the type of videos that will be checked")
+@click.option("--workers",
+              default=4,
+              type=int,
+              help="Number of videos checked at the same time")
+@click.option("--engine",
+              default="auto",
+              help="Decoder used for the check: auto, ffmpeg or opencv")
+@click.option("--force",
+              default=False,
+              help="Check again the videos that did not change since their last check")
+@pass_config
+def check_integrity(config, video_folder, videotype, workers, engine, force):
+    video_folder = json.loads(video_folder)
+
+    from analysissupport.dlc_support.auxfun_videos import check_folder_integrity
+    results = check_folder_integrity(video_folder, videotype=videotype, max_workers=workers,
+                                     engine=engine, force=force)
+
+    failed = [video for video, result in results.items() if not result['ok']]
+    click.echo('{} videos checked, {} with errors'.format(len(results), len(failed)))
+    for video in sorted(failed):
+        click.echo(video)
+        for error in results[video]['errors'][:5]:
+            click.echo('    ' + error)
+
 @cli.command()
 @pass_config
 def hello_world(config):
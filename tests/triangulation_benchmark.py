@@ -0,0 +1,52 @@
+import time
+import numpy as np
+from aniposelib.cameras import Camera, CameraGroup
+
+from analysissupport.anipose_support.triangulation_utils import triangulate_dlt, reprojection_error_batch
+
+
+def make_camera_group():
+    matrix = np.array([[1200, 0, 320],
+                       [0, 1200, 240],
+                       [0, 0, 1]], dtype='float64')
+    dist = np.array([-0.1, 0.01, 0, 0, 0], dtype='float64')
+    cam1 = Camera(name='cam1', size=(640, 480), matrix=matrix, dist=dist,
+                  rvec=np.array([0, 0.3, 0]), tvec=np.array([0, 0, 500]))
+    cam2 = Camera(name='cam2', size=(640, 480), matrix=matrix, dist=dist,
+                  rvec=np.array([0, -0.3, 0]), tvec=np.array([0, 0, 500]))
+    return CameraGroup([cam1, cam2])
+
+
+def make_points(cgroup, n_frames, n_joints, missing=0.05, noise=0.5):
+    rng = np.random.default_rng(0)
+    points_3d = rng.uniform(-50, 50, size=(n_frames * n_joints, 3))
+    points_2d = np.array([cam.project(points_3d).reshape(-1, 2) for cam in cgroup.cameras])
+    points_2d += rng.normal(scale=noise, size=points_2d.shape)
+    points_2d[rng.random(points_2d.shape[:2]) < missing] = np.nan
+    return points_2d
+
+
+def main(n_frames=2000, n_joints=10):
+    cgroup = make_camera_group()
+    points_flat = make_points(cgroup, n_frames, n_joints)
+
+    start = time.time()
+    p3d_ref = cgroup.triangulate(points_flat, progress=False)
+    err_ref = cgroup.reprojection_error(p3d_ref, points_flat, mean=True)
+    time_ref = time.time() - start
+
+    start = time.time()
+    p3d_dlt = triangulate_dlt(cgroup, points_flat)
+    err_dlt = reprojection_error_batch(cgroup, p3d_dlt, points_flat, mean=True)
+    time_dlt = time.time() - start
+
+    print('Frames: {}, joints: {}'.format(n_frames, n_joints))
+    print('aniposelib: {:10.1f} frames/s'.format(n_frames / time_ref))
+    print('dlt:        {:10.1f} frames/s'.format(n_frames / time_dlt))
+    print('Max point difference: {:.2e}'.format(np.nanmax(np.abs(p3d_ref - p3d_dlt))))
+    print('Max error difference: {:.2e}'.format(np.nanmax(np.abs(err_ref - err_dlt))))
+    print('Same missing points: {}'.format(np.array_equal(np.isnan(p3d_ref), np.isnan(p3d_dlt))))
+
+
+if __name__ == '__main__':
+    main()
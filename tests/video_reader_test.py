@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from analysissupport.dlc_support.auxfun_videos import VideoReader
+
+
+class CountingCapture:
+    # Forwards to a cv2.VideoCapture, counting the seeks and grabs
+    def __init__(self, capture):
+        self.capture = capture
+        self.seeks = 0
+        self.grabs = 0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            self.seeks += 1
+        return self.capture.set(prop, value)
+
+    def grab(self):
+        self.grabs += 1
+        return self.capture.grab()
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
+
+
+class ReadFramesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.video_path = os.path.join(self.folder, 'cam1_test.avi')
+        writer = cv2.VideoWriter(self.video_path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (64, 48))
+        for i in range(300):
+            writer.write(np.full((48, 64, 3), i % 255, dtype=np.uint8))
+        writer.release()
+
+    def read_frames(self, indices):
+        reader = VideoReader(self.video_path, use_cache=False)
+        capture = CountingCapture(reader.video)
+        reader._video = capture
+        frames = list(reader.read_frames(indices))
+        reader.close()
+        return frames, capture
+
+    def test_large_first_gap_seeks(self):
+        frames, capture = self.read_frames([5, 290])
+        self.assertEqual(capture.seeks, 2)
+        self.assertEqual(capture.grabs, 0)
+        self.assertTrue(all(frame is not None for frame in frames))
+
+    def test_small_gap_grabs(self):
+        frames, capture = self.read_frames([5, 10])
+        self.assertEqual(capture.seeks, 1)
+        self.assertEqual(capture.grabs, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()